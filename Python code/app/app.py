@@ -2,21 +2,55 @@ import atexit
 import os
 from quart import Quart, render_template, request
 from connection_controller import ConnectionController, CommunicationChannel, ServerMode
-from datetime import datetime
-import json
+from datetime import datetime, timezone
 
 app = Quart(__name__)
 controller = ConnectionController(app)
 
 
+def _parse_time(value):
+    """
+    A time from the query string, as naive UTC like the timestamps in the history. A time with an offset is converted,
+    one without is taken as UTC already.
+    """
+    try:
+        parsed = datetime.fromisoformat(value) if value else None
+    except ValueError:
+        return None
+    if parsed is not None and parsed.tzinfo is not None:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+    return parsed
+
+
 @app.route("/")
 async def log_view():
     cols = ["channel", "user_id", "user_message", "assistant_output", "timestamp", "processing_time"]
+    page = max(request.args.get("page", 1, type=int), 1)
+    size = min(max(request.args.get("size", 50, type=int), 1), 1000)
+    filters = {"tablet": request.args.get("tablet") or None,
+               "channel": request.args.get("channel") or None,
+               "since": request.args.get("since") or None,
+               "until": request.args.get("until") or None}
+
+    history, has_more = controller.history.query(limit=size, offset=(page - 1) * size,
+                                                 tablet_id=filters["tablet"],
+                                                 channel=filters["channel"].lower() if filters["channel"] else None,
+                                                 since=_parse_time(filters["since"]),
+                                                 until=_parse_time(filters["until"]))
     return await render_template("simple.html",
-                                 tables=[
-                                     controller.history_df.sort_values(by="timestamp", ascending=False)[cols].to_html(
-                                         classes="data")],
-                                 titles=controller.history_df.columns.values)
+                                 tables=[history[cols].to_html(classes="data")],
+                                 titles=history.columns.values,
+                                 page=page, size=size, has_more=has_more,
+                                 filters={k: v for k, v in filters.items() if v})
+
+
+@app.route("/stats")
+async def stats():
+    return {"ingest": controller.ingest_stats(), "writers": controller.writer_stats(),
+            "cache": controller.cache_stats(), "gpt": controller.gpt_stats(),
+            "openai": controller.openai_stats(), "sessions": controller.session_stats(),
+            "transcription": controller.transcription_stats(), "gazetteer": controller.gazetteer_stats(),
+            "history": controller.history_stats()}
 
 
 @app.route("/start_dialogue/<button_id>", methods=["POST"])
@@ -32,7 +66,7 @@ async def start_dialogue(button_id):
            "data": {},
            }
 
-    await controller._handle_request(json.dumps(msg))
+    await controller.handle_message(msg)  # warms up the cache when the tablet was not connected yet
     return f"Dialogue: {message_type}"
 
 
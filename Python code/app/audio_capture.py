@@ -0,0 +1,206 @@
+import asyncio
+import io
+import math
+import threading
+import time
+import wave
+from array import array
+
+CHANNELS = 1
+RATE = 16000
+CHUNK = 1024
+SAMPLE_WIDTH = 2  # 16 bit samples
+RECORD_SECONDS = 9
+STALL_SECONDS = 2  # a source that stops delivering chunks for longer than this past the end is given up on
+
+
+class MicrophoneSource(object):
+    """
+    The default input device of the server, PortAudio reads it on its own thread and hands over every chunk
+    """
+
+    def open(self, rate: int, chunk: int, on_chunk):
+        """
+        Start calling on_chunk(data) for every chunk until it returns False, returns a function that stops the source
+        """
+        import pyaudio  # only needed when recording from a real microphone
+
+        audio = pyaudio.PyAudio()
+
+        def callback(in_data, frame_count, time_info, status):
+            return None, pyaudio.paContinue if on_chunk(in_data) else pyaudio.paComplete
+
+        try:
+            stream = audio.open(format=pyaudio.paInt16,
+                                channels=CHANNELS,
+                                rate=rate,
+                                input=True,
+                                frames_per_buffer=chunk,
+                                stream_callback=callback)
+        except Exception:
+            audio.terminate()
+            raise
+
+        def close():
+            stream.stop_stream()
+            stream.close()
+            audio.terminate()
+
+        return close
+
+
+class SyntheticSource(object):
+    """
+    Stands in for the microphone: plays pcm (16 bit mono) chunk by chunk from a thread, followed by silence.
+    With realtime=False the chunks are handed over as fast as they are taken.
+    """
+
+    def __init__(self, pcm: bytes = b"", realtime=True):
+        self.pcm = bytes(pcm)
+        self.realtime = realtime
+
+    def open(self, rate: int, chunk: int, on_chunk):
+        stopped = threading.Event()
+        size = chunk * SAMPLE_WIDTH
+
+        def play():
+            position = 0
+            next_at = time.monotonic()
+            while not stopped.is_set():
+                data = self.pcm[position:position + size]
+                data += bytes(size - len(data))
+                position += size
+                if self.realtime:
+                    next_at += chunk / rate
+                    time.sleep(max(0.0, next_at - time.monotonic()))
+                if not on_chunk(data):
+                    break
+
+        thread = threading.Thread(target=play, name="synthetic-audio", daemon=True)
+        thread.start()
+
+        def close():
+            stopped.set()
+            thread.join()
+
+        return close
+
+
+def tone(seconds: float, frequency=220.0, amplitude=8000, rate=RATE):
+    """
+    A sine tone as 16 bit mono pcm, e.g. to feed a SyntheticSource
+    """
+    return array("h", (int(amplitude * math.sin(2 * math.pi * frequency * i / rate))
+                       for i in range(int(seconds * rate)))).tobytes()
+
+
+def silence(seconds: float, rate=RATE):
+    return bytes(int(seconds * rate) * SAMPLE_WIDTH)
+
+
+def to_wav(pcm, rate=RATE):
+    """
+    Wrap 16 bit mono pcm in a WAV container, in memory
+    """
+    wav = io.BytesIO()
+    with wave.open(wav, "wb") as wave_file:
+        wave_file.setnchannels(CHANNELS)
+        wave_file.setsampwidth(SAMPLE_WIDTH)
+        wave_file.setframerate(rate)
+        wave_file.writeframes(pcm)
+    wav.name = "audio.wav"  # the OpenAI client takes the file type from the name
+    wav.seek(0)
+    return wav
+
+
+class AudioCapture(object):
+    """
+    One recording from a source. The chunks are copied into a buffer that is allocated up front for the longest
+    recording, on the thread of the source, so the event loop is free while recording.
+    With a detector (see voice_activity) the recording stops once the speech has ended, and the silence before and
+    after the speech is trimmed off. The part recorded so far can be read while recording, see wait_until.
+    """
+
+    def __init__(self, source, rate=RATE, chunk=CHUNK, max_seconds=RECORD_SECONDS, detector=None):
+        self.source = source
+        self.rate = rate
+        self.chunk = chunk
+        self.detector = detector
+
+        self._buffer = bytearray(int(rate * max_seconds) * SAMPLE_WIDTH)
+        self._length = 0  # bytes recorded so far
+        self._limit = len(self._buffer)
+        self._loop = None
+        self._finished = None
+        self._progress = asyncio.Event()  # set after every chunk
+        self.done = False
+
+    def _on_chunk(self, data):
+        """
+        Called on the thread of the source, returns whether to keep recording
+        """
+        n = min(len(data), self._limit - self._length)
+        self._buffer[self._length:self._length + n] = data[:n]
+        self._length += n
+        ended = self.detector is not None and self.detector.feed(data[:n])
+        if ended or self._length >= self._limit:
+            self._loop.call_soon_threadsafe(self._finish)
+            return False
+        self._loop.call_soon_threadsafe(self._progress.set)
+        return True
+
+    def _finish(self):
+        if not self._finished.done():
+            self._finished.set_result(None)
+
+    async def record(self, seconds=RECORD_SECONDS):
+        """
+        Record for the given number of seconds (at most max_seconds) or until the speech has ended,
+        returns the 16 bit mono pcm as a memoryview
+        """
+        self._loop = asyncio.get_running_loop()
+        self._finished = self._loop.create_future()
+        self._limit = min(len(self._buffer), int(self.rate * seconds) * SAMPLE_WIDTH)
+
+        close = await asyncio.to_thread(self.source.open, self.rate, self.chunk, self._on_chunk)
+        try:
+            await asyncio.wait_for(self._finished, self._limit / SAMPLE_WIDTH / self.rate + STALL_SECONDS)
+        finally:
+            await asyncio.to_thread(close)
+            self.done = True
+            self._progress.set()
+        return self.pcm
+
+    async def wait_until(self, samples=None):
+        """
+        Wait until the given number of samples has been recorded, or the recording is done
+        """
+        while (samples is None or self._length < samples * SAMPLE_WIDTH) and not self.done:
+            self._progress.clear()
+            await self._progress.wait()
+
+    def speech_range(self):
+        """
+        The samples (start, end) of the speech heard so far, or None
+        """
+        if self.detector is None:
+            return None
+        return self.detector.speech_range(self._length // SAMPLE_WIDTH)
+
+    @property
+    def recorded(self):
+        return memoryview(self._buffer)[:self._length]
+
+    @property
+    def pcm(self):
+        """
+        The recording, without the silence around the speech when there is a detector that heard speech
+        """
+        speech = self.speech_range()
+        if speech is None:
+            return self.recorded
+        return self.recorded[speech[0] * SAMPLE_WIDTH:speech[1] * SAMPLE_WIDTH]
+
+    @property
+    def seconds(self):
+        return self._length / SAMPLE_WIDTH / self.rate
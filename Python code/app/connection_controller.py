@@ -2,30 +2,31 @@ import asyncio
 import copy
 import json
 import os
-import wave
 from datetime import datetime, timedelta
 from enum import Enum
 
 import aiohttp
 import dotenv
-import pandas as pd
-import pyaudio
 import websockets
 from openai import AsyncOpenAI
 
-from generators import gpt, simple, action, emote
+import envelope
+from audio_capture import AudioCapture, MicrophoneSource, RECORD_SECONDS
+from data_cache import DataCache
+from gazetteer import Gazetteer
+from history_store import HistoryStore, HistorySink
+from json_stream import JsonFieldExtractor, first_sentence
+from mailboxes import Mailboxes
+from openai_calls import OpenAICallManager
+from session_store import SessionStore
+from voice_activity import VoiceActivityDetector
+from socket_writer import SocketWriter, SendPriority
+from transcription import TranscriptionPipeline
+from generators import gpt, simple, action
 
 dotenv_file = dotenv.find_dotenv()
 dotenv.load_dotenv(dotenv_file)
 
-FORMAT = pyaudio.paInt16
-CHANNELS = 1
-RATE = 16000
-CHUNK = 1024
-RECORD_SECONDS = 9
-WAVE_OUTPUT_FILENAME = "output.wav"
-
-
 class ServerMode(str, Enum):
     PRODUCTION = "PRODUCTION"
     TEST = "TEST"
@@ -85,6 +86,91 @@ class RequestPrepend(str, Enum):
         return str(self.value).lower()
 
 
+class CacheNamespace(str, Enum):
+    CLIENT = "CLIENT"
+    CALENDAR = "CALENDAR"
+    REPORT = "REPORT"
+    WEATHER_NOW = "WEATHER_NOW"
+    WEATHER_FORECAST = "WEATHER_FORECAST"
+    NEWS = "NEWS"
+    GEOCODE = "GEOCODE"
+
+    def __str__(self):
+        return str(self.value).lower()
+
+
+# how long (in minutes) requested data stays valid before it is requested again
+CACHE_TTL_MINS = {CacheNamespace.CLIENT: 60,
+                  CacheNamespace.CALENDAR: 5,
+                  CacheNamespace.REPORT: 1,
+                  CacheNamespace.WEATHER_NOW: 5,
+                  CacheNamespace.WEATHER_FORECAST: 0.5,
+                  CacheNamespace.NEWS: 5,
+                  CacheNamespace.GEOCODE: 180}
+CACHE_MAX_ENTRIES = 4096
+WARM_UP_MIN_TTL_MINS = 2  # data that expires sooner is gone again by the first turn of a conversation, not warmed up
+DATA_REQUEST_TIMEOUT = 30  # seconds to wait for the response to a data request before it counts as failed
+CACHE_MAX_BYTES = 16 * 1024 * 1024
+
+GAZETTEER_SEED_FILES = "config/gazetteer/*.tsv"  # places that are known without asking OpenWeather
+GAZETTEER_LEARNED_FILE = "data/gazetteer-learned.tsv"  # places that OpenWeather found before
+GAZETTEER_TABLE_FILE = "data/gazetteer.dat"  # both compiled into a table, rebuilt when they change
+
+HISTORY_MAX_ROWS = 10000  # rows of message history kept in memory, everything is streamed to the log directory
+HISTORY_LOG_DIR = "logs"
+HISTORY_LOG_MAX_BYTES = 16 * 1024 * 1024  # start a new log segment once the current one is this large
+HISTORY_LOG_MAX_AGE_MINS = 24 * 60  # or this old
+HISTORY_LOG_COMPRESS = False  # gzip closed log segments
+HISTORY_LOG_QUEUE_SIZE = 16384  # rows waiting for the log writer, more are dropped
+
+INGEST_QUEUE_SIZE = 1024  # incoming websocket messages waiting to be handled
+INGEST_MAILBOX_SIZE = 64  # of which at most this many for a single tablet, more are dropped right away
+# tablets whose messages are handled at the same time, never more than one message per tablet. A handler mostly waits
+# (on the microphone for up to RECORD_SECONDS, on GPT for up to its deadline, on the pause before a foreground action)
+# so this bounds the work in progress, not the CPU: it is sized for every tablet of a large deployment to be served at
+# once, the OpenAI call manager caps the calls to OpenAI on its own
+INGEST_MAX_ACTIVE = 512
+INGEST_OVERFLOW_TIMEOUT = 5  # seconds a message may wait for room in a full queue before it is dropped
+
+GPT_MODEL = "gpt-4o"
+WHISPER_MODEL = "whisper-1"
+OPENAI_MAX_CONCURRENT = 16  # calls to openai in flight
+OPENAI_MAX_PER_MODEL = {GPT_MODEL: 12, WHISPER_MODEL: 8}
+GPT_SESSION_TTL_MINS = 30  # conversations with gpt are forgotten after this long without a new turn
+GPT_SESSION_MAX_CHARS = 4 * 1024 * 1024  # characters kept over all conversations, the least recently used go first
+GPT_DEADLINE = 60  # seconds a completion may take, including retries
+WHISPER_DEADLINE = 30  # seconds a transcription may take, including retries
+LISTEN_TRAILING_SILENCE = 0.8  # seconds of silence after which the user is done speaking
+LISTEN_MIN_SECONDS = 1.5  # seconds that are always recorded, RECORD_SECONDS is the longest recording
+TRANSCRIBE_FORMAT = "flac"  # or "wav"
+TRANSCRIBE_SEGMENT_SECONDS = 5  # longer recordings are transcribed in segments while recording, None for one upload
+TRANSCRIBE_OVERLAP_SECONDS = 1  # seconds of audio that two segments share, so no word is cut in half
+
+# generators of the first message of each type of conversation
+STARTERS = {"non-empathic-starter": simple.get_non_empathic_starter,
+            "basic-empathy-starter": gpt.get_basic_empathy_starter,
+            "rich-empathy-starter": gpt.get_rich_empathy_starter}
+
+# responses to our own data requests, these are handled as soon as they come in
+DATA_RESPONSE_TYPES = ["tablet_user_data", "tablet_user_calendar", "tablet_reports_and_configurations"]
+
+
+def _get_cache_namespace(queue_id: str):
+    if queue_id.startswith(RequestPrepend.GEOCODE):
+        return CacheNamespace.GEOCODE
+    if queue_id.endswith(RequestAppend.WEATHER + str(WeatherRequest.NOW)):
+        return CacheNamespace.WEATHER_NOW
+    if queue_id.endswith(RequestAppend.WEATHER + str(WeatherRequest.FORECAST)):
+        return CacheNamespace.WEATHER_FORECAST
+    if queue_id.endswith(RequestAppend.NEWS):
+        return CacheNamespace.NEWS
+    if RequestAppend.CALENDAR in queue_id:
+        return CacheNamespace.CALENDAR
+    if RequestAppend.REPORT in queue_id:
+        return CacheNamespace.REPORT
+    return CacheNamespace.CLIENT  # client data is stored under the bare tablet id
+
+
 def _get_server_id():
     server_id = ""
     try:
@@ -113,6 +199,12 @@ def _save_tablet_id(tablet_id: str):
     dotenv.set_key(dotenv_file, "TABLET_ID", tablet_id)
 
 
+def _get_user_id(data: dict):
+    if "data" in data and "user" in data["data"] and "id" in data["data"]["user"]:
+        return data["data"]["user"]["id"]
+    return ""
+
+
 def _get_dev_list():
     _dev_list = []
     try:
@@ -129,18 +221,64 @@ class ConnectionController(object):
         self._parent_app = app
         self.mode = ServerMode(os.getenv("SERVER_MODE"))
         self._dev_list = _get_dev_list()
+        self._dev_set = set(self._dev_list)  # Used to filter incoming messages by tablet id
 
         self._lizz_api_ws = None  # websocket connection will be established with the connect_websocket_as_server function
         self._lizz_tablet_ws = None  # websocket connection will be established with the connect_websocket_as_tablet function
+        self._api_writer = SocketWriter("server")  # all sends on the server connection go through this writer
+        self._tablet_writer = SocketWriter("tablet")  # all sends on the tablet connection go through this writer
         self._external_api = None  # http request session will be established with the connect_external function
         self._openai_api = None  # client for the openai chatgpt requests will be established with the connect_openai function
+        self._openai_calls = OpenAICallManager(max_concurrent=OPENAI_MAX_CONCURRENT,
+                                               max_per_model=OPENAI_MAX_PER_MODEL)  # every call to openai goes through this
+        self.audio_source = MicrophoneSource()  # where listen_to_audio records from, e.g. a SyntheticSource in tests
+        self._transcription = TranscriptionPipeline(self.transcribe_with_whisper, audio_format=TRANSCRIBE_FORMAT,
+                                                    segment_seconds=TRANSCRIBE_SEGMENT_SECONDS,
+                                                    overlap_seconds=TRANSCRIBE_OVERLAP_SECONDS)  # every recording is transcribed through this
         self._connected_tablets = {}  # Used to track connection status of connected tablets {tablet_id : status}
-        self._data_queue = {}  # Used to track incoming responses to our requests {request_id : response}
-        self._gpt_history = {}  # Used to track history from gpt conversation
-
-        self.history_df = pd.DataFrame(
-            columns=["channel", "user_id", "tablet_id", "user_message", "assistant_output", "timestamp",
-                     "processing_time"])
+        self._data_queue = DataCache(ttl_mins=CACHE_TTL_MINS, namespace_of=_get_cache_namespace,
+                                     evictable=lambda entry: (entry["status"] != RequestStatus.PENDING
+                                                              and not entry.get("waiters")),
+                                     max_entries=CACHE_MAX_ENTRIES,
+                                     max_bytes=CACHE_MAX_BYTES)  # Used to track incoming responses to our requests {request_id : response}
+        self._in_flight = {}  # Used to share running data requests between concurrent callers {request_id : future}
+        self._gazetteer = Gazetteer(seed_files=GAZETTEER_SEED_FILES, learned_file=GAZETTEER_LEARNED_FILE,
+                                    table_file=GAZETTEER_TABLE_FILE)  # Used to geocode locations without a request
+        self._gpt_sessions = SessionStore(ttl_mins=GPT_SESSION_TTL_MINS,
+                                          max_chars=GPT_SESSION_MAX_CHARS)  # Used to track history from gpt conversation {tablet_id : turns}
+        self._gpt_usage = {"completions": 0, "prompt_tokens": 0, "cached_tokens": 0, "completion_tokens": 0,
+                           "seconds": 0}  # Used to track token usage and prompt cache hits of gpt completions
+
+        # Used to route incoming messages, first on their type and otherwise on their message id
+        self._type_handlers = {"disconnected": self._handle_disconnect,
+                               "non-empathic-starter": self._handle_starter,
+                               "basic-empathy-starter": self._handle_starter,
+                               "rich-empathy-starter": self._handle_starter,
+                               "external_interaction_response": self._handle_interaction_response,
+                               "tablet_user_data": self._handle_data_response,
+                               "tablet_user_calendar": self._handle_calendar_response,
+                               "tablet_reports_and_configurations": self._handle_report_response,
+                               "error": self._handle_error}
+        self._message_id_handlers = {"rich-empathy-conversation": self._handle_conversation_request,
+                                     "basic-empathy-conversation": self._handle_conversation_request,
+                                     "conversation": self._handle_conversation_request,
+                                     "conversation-end": self._handle_conversation_end}
+        self._ingest_queue = Mailboxes(maxsize=INGEST_QUEUE_SIZE,
+                                       max_per_key=INGEST_MAILBOX_SIZE)  # Used to hand incoming messages to the handlers {tablet_id : [msg]}
+        self._ingest_metrics = {"received": 0, "rejected": 0, "handled": 0, "failed": 0, "overflows": 0,
+                                "dropped": 0, "max_depth": 0}
+
+        self.history = HistoryStore(max_rows=HISTORY_MAX_ROWS)  # Used to track recent message history
+        self._history_sink = HistorySink(log_dir=HISTORY_LOG_DIR, max_bytes=HISTORY_LOG_MAX_BYTES,
+                                         max_age_mins=HISTORY_LOG_MAX_AGE_MINS,
+                                         compress=HISTORY_LOG_COMPRESS, max_queue=HISTORY_LOG_QUEUE_SIZE,
+                                         channel=CommunicationChannel.QUART_SERVER)  # Used to stream the history to disk
+
+    def add_background_task(self, func, *args, **kwargs):
+        """
+        Run func(*args, **kwargs) as a background task of the app, e.g. work a response does not have to wait for
+        """
+        self._parent_app.add_background_task(func, *args, **kwargs)
 
     def save_to_history(self, channel: str, user="", tablet="", message_in="", message_out="",
                         start_time: datetime = None):
@@ -151,147 +289,209 @@ class ConnectionController(object):
         if not start_time:
             start_time = now
         processing_time = now - start_time
-        new_record = pd.DataFrame(
-            data={"channel": channel,
-                  "user_id": user,
-                  "tablet_id": tablet,
-                  "user_message": message_in,
-                  "assistant_output": message_out,
-                  "timestamp": now,
-                  "processing_time": processing_time}, index=[1])
+        self.history.append(channel=channel, user_id=user, tablet_id=tablet, user_message=message_in,
+                            assistant_output=message_out, timestamp=now, processing_time=processing_time)
+        self._history_sink.write(channel=channel, user_id=user, tablet_id=tablet, user_message=message_in,
+                                 assistant_output=message_out, timestamp=now, processing_time=processing_time)
 
-        self.history_df = pd.concat([self.history_df, new_record], ignore_index=True)
+    @property
+    def history_df(self):
+        return self.history.to_frame()
 
     def dump_history(self):
-        now = datetime.utcnow().strftime("%d-%m-%Y %H-%M-%S")
-        self.history_df.to_csv("logs/" + now + ".log", sep="\t")
-        print("[" + CommunicationChannel.QUART_SERVER + "] Wrote message history to 'logs/" + now + ".log'")
+        """
+        Flush the last records of the message history to disk
+        """
+        self._history_sink.close()
+        print("[" + CommunicationChannel.QUART_SERVER + "] Wrote message history to '" + HISTORY_LOG_DIR + "/'")
+
+    def _accepts(self, data: dict):
+        """
+        Only tablet messages are handled, in develop mode only those of the dev tablets and otherwise all but those
+        """
+        if "client" not in data or data["client"].get("type") != "TABLET":
+            return False
+        return (data["client"]["id"] in self._dev_set) == (self.mode == ServerMode.DEVELOP)
 
     async def _handle_request(self, msg: str):
-        data = json.loads(msg)
+        return await self.handle_message(json.loads(msg))
 
-        if data["client"]["type"] != "TABLET":
+    async def handle_message(self, data: dict):
+        """
+        Handle an incoming message that was already decoded
+        """
+        if not self._accepts(data):
             return
 
-        start_time = datetime.utcnow()
-        tablet_id = data["client"]["id"]
+        if data["type"] != "disconnected":
+            self._mark_connected(data)
 
-        user_id = ""
-        if "data" in data and "user" in data["data"] and "id" in data["data"]["user"]:
-            user_id = data["data"]["user"]["id"]
+        handler = self._type_handlers.get(data["type"])
+        if handler is None and "data" in data and "message_id" in data["data"]:
+            handler = self._message_id_handlers.get(data["data"]["message_id"])
+        if handler is not None:
+            return await handler(data)
 
-        if self.mode != ServerMode.DEVELOP:
-            if tablet_id in self._dev_list:
-                return
-        elif tablet_id not in self._dev_list:
+    def _mark_connected(self, data: dict):
+        tablet_id = data["client"]["id"]
+        if self._connected_tablets.get(tablet_id) is ConnectionStatus.CONNECTED:
             return
+        self._connected_tablets[tablet_id] = ConnectionStatus.CONNECTED
+        print("[" + CommunicationChannel.LIZZ_API + " (IN)] Connected with tablet with id " + tablet_id)
+        self.save_to_history(channel=CommunicationChannel.LIZZ_API, user=_get_user_id(data), tablet=tablet_id,
+                             message_in="tablet_connected", message_out="")
+        self.add_background_task(self.warm_up, tablet_id)
 
+    async def _handle_disconnect(self, data: dict):
+        tablet_id = data["client"]["id"]
+        self._connected_tablets[tablet_id] = ConnectionStatus.DISCONNECTED
+        self.save_to_history(channel=CommunicationChannel.LIZZ_API, user=_get_user_id(data), tablet=tablet_id,
+                             message_in="tablet_disconnected", message_out="")
+
+    async def _handle_starter(self, data: dict):
+        if data["type"] != "non-empathic-starter":
+            self._gpt_sessions.reset(data["client"]["id"])
+        return await self._respond(msg=STARTERS[data["type"]](data["client"]["id"]),
+                                   channel=CommunicationChannel.LIZZ_API)
+
+    async def _handle_interaction_response(self, data: dict):
+        if data["data"]["buttonPressed"]["value"] != "finish-conversation":
+            transcription = await self.listen_to_audio()
+            tablet = data["client"]["id"]
+            await self._api_writer.send(envelope.typing_message(data["client"]), SendPriority.HIGH)  # first queue the message
+            await self.show_dialogue_screen(tablet)  # if that was successful, show the dialogue screen
+            message_text = await transcription
+            if data["data"]["message"]["data"]["message_id"] in ["rich-empathy-conversation",
+                                                                 "basic-empathy-conversation"]:
+                responseButton = {"value": data["data"]["buttonPressed"]["value"],
+                                  "label": message_text}
+            else:
+                responseButton = {"value": data["data"]["buttonPressed"]["value"],
+                                  "label": data["data"]["buttonPressed"]["label"]}
+        else:
+            responseButton = {"value": data["data"]["buttonPressed"]["value"],
+                              "label": data["data"]["buttonPressed"]["label"]}
+        response = data["data"]["message"]
+        response["data"]["responseButton"] = responseButton
+        if responseButton["value"] == "finish-conversation":
+            response["data"]["message_id"] = "conversation"  # stop using chat-gpt
+        response["type"] = "external_interaction_response"
+        return await self._handle_conversation_request(response)
+
+    async def _handle_error(self, data: dict):
+        print("[" + CommunicationChannel.LIZZ_API + " (IN)] Received an error message from the server:" +
+              json.dumps(data))
+        self.save_to_history(channel=CommunicationChannel.LIZZ_API, user=_get_user_id(data),
+                             tablet=data["client"]["id"],
+                             message_in=data["type"] + "_" + str(data["statusCode"]),
+                             message_out=data["message"])
+
+    async def _listen_for_requests(self, max_active=INGEST_MAX_ACTIVE, interval=0.1):
         """
-        Process messages related to connection status
+        Read the websocket as a stream and hand every message to a bounded queue, from which each message is handled in
+        a task of its own. Every tablet has its own mailbox, its messages are handled one at a time in the order they
+        arrived while the tablets take turns, and at most max_active tablets are handled at the same time. Responses to our data requests skip the mailboxes, the messages waiting for them might be
+        holding up the mailbox of that same tablet.
+        A message for a tablet whose mailbox is full is dropped right away, reading never waits for a single tablet.
+        When the handlers fall behind on all tablets the queue fills up and reading from the socket pauses, a message that
+        still finds no room after INGEST_OVERFLOW_TIMEOUT seconds is dropped.
         """
-        if data["type"] == "disconnected":
-            self._connected_tablets[tablet_id] = ConnectionStatus.DISCONNECTED
-            self.save_to_history(channel=CommunicationChannel.LIZZ_API, user=user_id, tablet=tablet_id,
-                                 message_in="tablet_disconnected",
-                                 message_out="", start_time=start_time)
+        while self._lizz_api_ws is None:  # the server connection is established after the tablet connection
+            await asyncio.sleep(interval)
+
+        dispatcher = asyncio.create_task(self._dispatch_ingested(max_active))
+        try:
+            async for msg in self._lizz_api_ws:
+                await self._ingest(msg)
+            await self._ingest_queue.join()  # the socket closed, finish what was already received
+        finally:
+            dispatcher.cancel()
+
+    async def _ingest(self, msg: str):
+        self._ingest_metrics["received"] += 1
+        try:
+            data = json.loads(msg)
+            accepted = self._accepts(data)
+        except Exception as e:
+            self._ingest_metrics["failed"] += 1
+            print("[" + CommunicationChannel.LIZZ_API + " (IN)] Could not read message: " + e.__str__())
             return
 
-        elif (tablet_id not in self._connected_tablets or
-              self._connected_tablets[tablet_id] is not ConnectionStatus.CONNECTED):
-            self._connected_tablets[tablet_id] = ConnectionStatus.CONNECTED
-            print("[" + CommunicationChannel.LIZZ_API + " (IN)] Connected with tablet with id " + tablet_id)
-            self.save_to_history(channel=CommunicationChannel.LIZZ_API, user=user_id, tablet=tablet_id,
-                                 message_in="tablet_connected",
-                                 message_out="", start_time=start_time)
+        if not accepted:
+            self._ingest_metrics["rejected"] += 1
+            return
+
+        if data.get("type") in DATA_RESPONSE_TYPES:
+            return await self._handle_ingested(data)
+
+        tablet_id = data["client"]["id"]
+        if self._ingest_queue.full(tablet_id):  # never wait for a single tablet, that would hold up all the others
+            self._ingest_metrics["dropped"] += 1
+            print("[" + CommunicationChannel.LIZZ_API + " (IN)] Mailbox of tablet " + tablet_id +
+                  " is full, dropped message: " + msg)
+            return
+        if self._ingest_queue.full():
+            self._ingest_metrics["overflows"] += 1
+        try:
+            queued = await asyncio.wait_for(self._ingest_queue.put(tablet_id, data), INGEST_OVERFLOW_TIMEOUT)
+        except asyncio.TimeoutError:
+            queued = False
+        if not queued:
+            self._ingest_metrics["dropped"] += 1
+            print("[" + CommunicationChannel.LIZZ_API + " (IN)] Incoming queue is full, dropped message: " + msg)
+            return
+        self._ingest_metrics["max_depth"] = max(self._ingest_metrics["max_depth"], self._ingest_queue.qsize())
 
+    async def _dispatch_ingested(self, max_active: int):
         """
-        Process messages related to conversation
+        Start a task for the next message of every tablet in turn, while fewer than max_active tablets are handled
         """
-        if data["type"] == "non-empathic-starter":
-            return await self._respond(msg=simple.get_non_empathic_starter(tablet_id),
-                                       channel=CommunicationChannel.LIZZ_API)
-
-        if data["type"] == "basic-empathy-starter":
-            self._gpt_history = {}
-            return await self._respond(msg=gpt.get_basic_empathy_starter(tablet_id),
-                                       channel=CommunicationChannel.LIZZ_API)
-
-        if data["type"] == "rich-empathy-starter":
-            self._gpt_history = {}
-            return await self._respond(msg=gpt.get_rich_empathy_starter(tablet_id),
-                                       channel=CommunicationChannel.LIZZ_API)
-
-        if data["type"] == "external_interaction_response":
-            if data["data"]["buttonPressed"]["value"] != "finish-conversation":
-                audio = await self.listen_to_audio()
-                tablet = data["client"]["id"]
-                message_data = {"message": "...",
-                                "messageTts": "   ",
-                                "message_id": "is-typing",
-                                "buttons": [],
-                                "extra": json.dumps(emote.get_emotes_from_keys({})),
-                                "listen": "manual"}
-                outgoing_message = {"type": "external_interaction_message",
-                                    "data": message_data,
-                                    "client": data["client"]}
-                await self._lizz_api_ws.send(json.dumps(outgoing_message))  # first queue the message
-                await self.show_dialogue_screen(tablet)  # if that was successful, show the dialogue screen
-                message_text = await self.transcribe_with_whisper(audio)
-                if data["data"]["message"]["data"]["message_id"] in ["rich-empathy-conversation",
-                                                                     "basic-empathy-conversation"]:
-                    responseButton = {"value": data["data"]["buttonPressed"]["value"],
-                                      "label": message_text}
-                else:
-                    responseButton = {"value": data["data"]["buttonPressed"]["value"],
-                                      "label": data["data"]["buttonPressed"]["label"]}
-            else:
-                responseButton = {"value": data["data"]["buttonPressed"]["value"],
-                                  "label": data["data"]["buttonPressed"]["label"]}
-            response = data["data"]["message"]
-            response["data"]["responseButton"] = responseButton
-            if responseButton["value"] == "finish-conversation":
-                response["data"]["message_id"] = "conversation"  # stop using chat-gpt
-            response["type"] = "external_interaction_response"
-            return await self._handle_conversation_request(response)
+        active = asyncio.Semaphore(max_active)
+        tasks = set()
 
-        elif "data" in data and "message_id" in data["data"] and data["data"]["message_id"] in \
-                ["rich-empathy-conversation", "basic-empathy-conversation", "conversation"]:
-            return await self._handle_conversation_request(data)
+        async def handle(tablet_id, data):
+            try:
+                await self._handle_ingested(data)
+            finally:
+                active.release()
+                await self._ingest_queue.done(tablet_id)
 
-        elif "data" in data and "message_id" in data["data"] and data["data"]["message_id"] == "conversation-end":
-            return await self._handle_conversation_end(data)
+        try:
+            while True:
+                await active.acquire()
+                tablet_id, data = await self._ingest_queue.get()
+                task = asyncio.create_task(handle(tablet_id, data))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def _handle_ingested(self, data: dict):
+        try:
+            await self.handle_message(data)
+            self._ingest_metrics["handled"] += 1
+        except Exception as e:
+            self._ingest_metrics["failed"] += 1
+            print("[" + CommunicationChannel.LIZZ_API + " (IN)] Could not handle message: " + e.__str__())
 
-        """
-        Process messages related to data
-        """
-        if data["type"] == "tablet_user_data":
-            return await self._handle_data_response(data=data)
-        elif data["type"] == "tablet_user_calendar":
-            return await self._handle_calendar_response(data=data)
-        elif data["type"] == "tablet_reports_and_configurations":
-            return await self._handle_report_response(data=data)
+    def ingest_stats(self):
+        return dict(self._ingest_metrics, depth=self._ingest_queue.qsize(), capacity=self._ingest_queue.maxsize,
+                    tablets=self._ingest_queue.keys())
 
-        """
-        Process error messages
-        """
-        if data["type"] == "error":
-            print(
-                "[" + CommunicationChannel.LIZZ_API + " (IN)] Received an error message from the server:" + msg)
-            self.save_to_history(channel=CommunicationChannel.LIZZ_API, user=user_id, tablet=tablet_id,
-                                 message_in=data["type"] + "_" + str(data["statusCode"]),
-                                 message_out=data["message"], start_time=start_time)
+    def cache_stats(self):
+        return self._data_queue.stats()
 
-    async def _listen_for_requests(self, interval=0.1):
-        while True:
-            if self._lizz_api_ws is not None:
-                msg = await self._lizz_api_ws.recv()
-                self._parent_app.add_background_task(self._handle_request, msg)
+    def history_stats(self):
+        return self._history_sink.stats()
 
-            await asyncio.sleep(interval)
+    def writer_stats(self):
+        return {self._api_writer.name: self._api_writer.stats(), self._tablet_writer.name: self._tablet_writer.stats()}
 
     async def connect_open_ai(self):
         print("[" + CommunicationChannel.OPENAI_API + "] Establishing GPT client...")
-        self._openai_api = AsyncOpenAI(api_key=os.environ.get("OPEN_AI_KEY"))
+        self._openai_api = AsyncOpenAI(api_key=os.environ.get("OPEN_AI_KEY"),
+                                       max_retries=0)  # retries are left to the call manager
         print("[" + CommunicationChannel.OPENAI_API + "] Successfully established GPT client, ready for completion!")
 
     async def connect_external(self, interval=60):
@@ -320,8 +520,12 @@ class ConnectionController(object):
             _save_server_id(iot_id)
 
             print("[" + CommunicationChannel.LIZZ_API + "] Now listening for responses...")
-            while True:
-                await asyncio.sleep(interval)  # we are not actually looking to respond to any messages as a 'tablet'
+            writer = asyncio.create_task(self._api_writer.run(websocket_))
+            try:
+                while True:
+                    await asyncio.sleep(interval)  # we are not actually looking to respond to any messages as a 'tablet'
+            finally:
+                writer.cancel()
 
     async def connect_to_socket_as_tablet(self, address):
         print("[" + CommunicationChannel.LIZZ_API + "] Connecting to LIZZ API as 'tablet'...")
@@ -339,7 +543,11 @@ class ConnectionController(object):
             self._lizz_tablet_ws = websocket_
             print("[" + CommunicationChannel.LIZZ_API + "] Successfully connected to LIZZ API! Tablet ID is " + iot_id)
             _save_tablet_id(iot_id)
-            await self._listen_for_requests()  # This while True loop will take it from here
+            writer = asyncio.create_task(self._tablet_writer.run(websocket_))
+            try:
+                await self._listen_for_requests()  # This while True loop will take it from here
+            finally:
+                writer.cancel()
 
     async def _get_report_defaults(self, tablet_id: str):
         start_time = datetime.utcnow()
@@ -372,7 +580,7 @@ class ConnectionController(object):
                              message_in="", message_out="report_sleep_quality",
                              start_time=start_time)
 
-        await self._lizz_tablet_ws.send(json.dumps(outgoing_message))
+        await self._tablet_writer.send(json.dumps(outgoing_message), SendPriority.LOW)
 
     async def send_meal_report(self, tablet_id: str, response: str, question="Have you had your meal?"):
         start_time = datetime.utcnow()
@@ -385,7 +593,7 @@ class ConnectionController(object):
         self.save_to_history(channel=CommunicationChannel.LIZZ_API, tablet=tablet_id,
                              message_in="", message_out="report_meal",
                              start_time=start_time)
-        await self._lizz_tablet_ws.send(json.dumps(outgoing_message))
+        await self._tablet_writer.send(json.dumps(outgoing_message), SendPriority.LOW)
 
     async def send_medication_report(self, tablet_id: str, response: str, question="Have you had your medication?"):
         start_time = datetime.utcnow()
@@ -398,7 +606,7 @@ class ConnectionController(object):
         self.save_to_history(channel=CommunicationChannel.LIZZ_API, tablet=tablet_id,
                              message_in="", message_out="report_medication",
                              start_time=start_time)
-        await self._lizz_tablet_ws.send(json.dumps(outgoing_message))
+        await self._tablet_writer.send(json.dumps(outgoing_message), SendPriority.LOW)
 
     async def send_mood_report(self, tablet_id: str, response: str, question="How do you feel?"):
         start_time = datetime.utcnow()
@@ -411,7 +619,7 @@ class ConnectionController(object):
         self.save_to_history(channel=CommunicationChannel.LIZZ_API, tablet=tablet_id,
                              message_in="", message_out="report_mood",
                              start_time=start_time)
-        await self._lizz_tablet_ws.send(json.dumps(outgoing_message))
+        await self._tablet_writer.send(json.dumps(outgoing_message), SendPriority.LOW)
 
     async def send_activity_report(self, tablet_id: str, response: str, question="Were you active today?"):
         start_time = datetime.utcnow()
@@ -424,7 +632,7 @@ class ConnectionController(object):
         self.save_to_history(channel=CommunicationChannel.LIZZ_API, tablet=tablet_id,
                              message_in="", message_out="report_activity",
                              start_time=start_time)
-        await self._lizz_tablet_ws.send(json.dumps(outgoing_message))
+        await self._tablet_writer.send(json.dumps(outgoing_message), SendPriority.LOW)
 
     async def show_video(self, tablet_id: str, title: str, url: str):
         start_time = datetime.utcnow()
@@ -441,7 +649,7 @@ class ConnectionController(object):
         self.save_to_history(channel=CommunicationChannel.LIZZ_API, tablet=tablet_id,
                              message_in="", message_out="tablet_show_video",
                              start_time=start_time)
-        await self._lizz_api_ws.send(json.dumps(outgoing_message))
+        await self._api_writer.send(json.dumps(outgoing_message))
 
     async def show_dialogue_screen(self, tablet_id: str):
         start_time = datetime.utcnow()
@@ -457,7 +665,7 @@ class ConnectionController(object):
         self.save_to_history(channel=CommunicationChannel.LIZZ_API, tablet=tablet_id,
                              message_in="", message_out="tablet_show_dialogue",
                              start_time=start_time)
-        await self._lizz_api_ws.send(json.dumps(outgoing_message))
+        await self._api_writer.send(json.dumps(outgoing_message), SendPriority.HIGH)
 
     async def show_home_screen(self, tablet_id: str):
         start_time = datetime.utcnow()
@@ -473,7 +681,7 @@ class ConnectionController(object):
         self.save_to_history(channel=CommunicationChannel.LIZZ_API, tablet=tablet_id,
                              message_in="", message_out="tablet_show_home",
                              start_time=start_time)
-        await self._lizz_api_ws.send(json.dumps(outgoing_message))
+        await self._api_writer.send(json.dumps(outgoing_message), SendPriority.HIGH)
 
     async def _respond(self, msg: dict, channel: CommunicationChannel, delay_before_foreground_action=5):
         start_time = datetime.utcnow()
@@ -487,19 +695,10 @@ class ConnectionController(object):
             user_id = msg["data"]["user"]["id"] if "user" in msg["data"] and "id" in msg["data"]["user"] else ""
             message_type = msg["data"]["responseButton"]["value"]
             message_text = msg["data"]["responseButton"]["label"]
-            message_data = {"message": "...",
-                            "messageTts": "   ",
-                            "message_id": "is-typing",
-                            "buttons": [],
-                            "extra": json.dumps(emote.get_emotes_from_keys({})),
-                            "listen": "manual"}
-            outgoing_message = {"type": "external_interaction_message",
-                                "data": message_data,
-                                "client": msg["client"]}
             self.save_to_history(channel=channel, user=user_id, tablet=tablet,
-                                 message_in=message_text, message_out=outgoing_message["data"]["message"],
+                                 message_in=message_text, message_out="...",
                                  start_time=start_time)
-            await self._lizz_api_ws.send(json.dumps(outgoing_message))  # first queue the message
+            await self._api_writer.send(envelope.typing_message(msg["client"]), SendPriority.HIGH)  # first queue the message
             await self.show_dialogue_screen(tablet)  # if that was successful, show the dialogue screen
 
             start_time = datetime.utcnow()
@@ -529,7 +728,7 @@ class ConnectionController(object):
 
             if outgoing_message["data"]["message_id"] == "conversation-end":
                 outgoing_message["data"]["buttons"] = []
-                outgoing_message["data"]["messageTts"] = outgoing_message["data"]["message"]
+                outgoing_message["data"].setdefault("messageTts", outgoing_message["data"]["message"])
                 outgoing_message["data"]["listen"] = "manual"
                 if not foreground_action:
                     if not tablet_actions:
@@ -540,22 +739,17 @@ class ConnectionController(object):
                 outgoing_message["data"]["listen"] = "after-tts"
                 if not outgoing_message["data"]["buttons"]:
                     outgoing_message["data"]["buttons"] = []
-                    outgoing_message["data"]["messageTts"] = outgoing_message["data"]["message"]
-                else:
-                    outgoing_message["data"]["messageTts"] = outgoing_message["data"]["message"]
+                # the generator sets its own text to speech when part of the message was already spoken
+                outgoing_message["data"].setdefault("messageTts", outgoing_message["data"]["message"])
             if foreground_action:
-                if "extra" in outgoing_message["data"]:
-                    extra = json.loads(outgoing_message["data"]["extra"])
-                else:
-                    extra = {}
-                extra["hideAfter"] = delay_before_foreground_action
-                outgoing_message["data"]["extra"] = json.dumps(extra)
+                extra = outgoing_message["data"].get("extra") or {}
+                outgoing_message["data"]["extra"] = dict(extra, hideAfter=delay_before_foreground_action)
 
             self.save_to_history(channel=channel, user=user_id, tablet=tablet,
                                  message_in=message_text, message_out=outgoing_message["data"]["message"],
                                  start_time=start_time)
 
-            await self._lizz_api_ws.send(json.dumps(outgoing_message))  # first queue the message
+            await self._api_writer.send(envelope.encode(outgoing_message), SendPriority.HIGH)  # first queue the message
             await self.show_dialogue_screen(tablet)  # if that was successful, show the dialogue screen
 
             if foreground_action:
@@ -567,6 +761,47 @@ class ConnectionController(object):
                                  message_in=message_text, message_out="error, failed to respond: " + e.__str__(),
                                  start_time=start_time)
 
+    def _queue_request(self, queue_id: str, start_time: datetime):
+        """
+        Register a pending request, waiters block on its event until a response resolves it
+        """
+        if queue_id in self._data_queue and self._data_queue[queue_id]["status"] == RequestStatus.PENDING:
+            self._data_queue[queue_id]["requested_at"] = start_time  # keep the entry, its waiters hold on to it
+            return
+        self._data_queue[queue_id] = {"status": RequestStatus.PENDING, "requested_at": start_time,
+                                      "event": asyncio.Event(), "waiters": 0}
+
+    def _resolve_request(self, queue_id: str, status: RequestStatus, data=None):
+        entry = self._data_queue[queue_id]
+        if data is not None:
+            entry["data"] = data
+        entry["status"] = status
+        entry["event"].set()  # wake up everyone waiting for this request
+        self._data_queue.measure(queue_id)  # may evict other entries, but not this one or any with waiters
+
+    async def _await_request(self, queue_id: str):
+        """
+        Wait for the response to a request. Without a response within DATA_REQUEST_TIMEOUT seconds of the request it
+        is resolved as failed, so the next caller requests it again.
+        """
+        entry = self._data_queue.get(queue_id)
+        if entry is None:  # the request was never sent, or its response was evicted already
+            return None
+        entry["waiters"] = entry.get("waiters", 0) + 1  # the cache does not evict entries that are waited for
+        try:
+            while entry["status"] == RequestStatus.PENDING:
+                waited = (datetime.utcnow() - entry["requested_at"]).total_seconds()
+                await asyncio.wait_for(entry["event"].wait(), DATA_REQUEST_TIMEOUT - waited)
+        except asyncio.TimeoutError:
+            if entry["status"] == RequestStatus.PENDING:
+                print("[" + CommunicationChannel.QUART_SERVER + "] No response to request " + queue_id + " within " +
+                      str(DATA_REQUEST_TIMEOUT) + " seconds")
+                entry["status"] = RequestStatus.FAILED
+                entry["event"].set()
+        finally:
+            entry["waiters"] -= 1
+        return entry.get("data")
+
     async def _request_tablet_user_data(self, tablet_id: str, user_id=""):
         start_time = datetime.utcnow()
 
@@ -576,9 +811,9 @@ class ConnectionController(object):
         outgoing_message = {"type": "tablet_user_data",
                             "client": {"id": tablet_id}
                             }
-        self._data_queue[tablet_id] = {"status": RequestStatus.PENDING, "requested_at": start_time}
+        self._queue_request(tablet_id, start_time)
 
-        await self._lizz_api_ws.send(json.dumps(outgoing_message))
+        await self._api_writer.send(json.dumps(outgoing_message))
         print(
             "[" + CommunicationChannel.LIZZ_API + " (OUT)] Fetching client user data for tablet with id: " + tablet_id)
         self.save_to_history(channel=CommunicationChannel.LIZZ_API, user=user_id, tablet=tablet_id, message_in="",
@@ -596,9 +831,9 @@ class ConnectionController(object):
                             "client": {"id": tablet_id},
                             "data": {"queue_id": queue_id, "day": day.strftime("%Y-%m-%d")}
                             }
-        self._data_queue[queue_id] = {"status": RequestStatus.PENDING, "requested_at": start_time}
+        self._queue_request(queue_id, start_time)
 
-        await self._lizz_api_ws.send(json.dumps(outgoing_message))
+        await self._api_writer.send(json.dumps(outgoing_message))
         print(
             "[" + CommunicationChannel.LIZZ_API + " (OUT)] Fetching client calendar data for tablet with id: " + tablet_id)
         self.save_to_history(channel=CommunicationChannel.LIZZ_API, user=user_id, tablet=tablet_id, message_in="",
@@ -619,9 +854,9 @@ class ConnectionController(object):
                                      "from": (day - timedelta(hours=lookback_hours)).strftime("%Y-%m-%dT%H:%M:%S.000Z"),
                                      "to": day.strftime("%Y-%m-%dT%H:%M:%S.000Z")}
                             }
-        self._data_queue[queue_id] = {"status": RequestStatus.PENDING, "requested_at": start_time}
+        self._queue_request(queue_id, start_time)
 
-        await self._lizz_api_ws.send(json.dumps(outgoing_message))
+        await self._api_writer.send(json.dumps(outgoing_message))
         print(
             "[" + CommunicationChannel.LIZZ_API + " (OUT)] Fetching client user data for tablet with id: " + tablet_id)
         self.save_to_history(channel=CommunicationChannel.LIZZ_API, user=user_id, tablet=tablet_id, message_in="",
@@ -653,7 +888,7 @@ class ConnectionController(object):
         else:
             return {"success": False, "id": queue_id, "message": "Invalid weather request type"}
 
-        self._data_queue[queue_id] = {"status": RequestStatus.PENDING, "requested_at": start_time}
+        self._queue_request(queue_id, start_time)
         self.save_to_history(channel=CommunicationChannel.EXTERNAL, user=user_id, tablet=tablet_id, message_in="",
                              message_out="weather_request_" + str(request_type), start_time=start_time)
         success = False
@@ -661,15 +896,13 @@ class ConnectionController(object):
             resp = await self._external_api.get(url, params=params)
             response = await resp.json()
             if "cod" not in response or str(response["cod"]) != "200":
-                self._data_queue[queue_id]["status"] = RequestStatus.FAILED
-                self._data_queue[queue_id]["data"] = []
+                self._resolve_request(queue_id, RequestStatus.FAILED, data=[])
             else:
-                self._data_queue[queue_id]["status"] = RequestStatus.RECEIVED
-                self._data_queue[queue_id]["data"] = response
+                self._resolve_request(queue_id, RequestStatus.RECEIVED, data=response)
                 success = True
 
         except Exception as e:
-            self._data_queue[queue_id]["status"] = RequestStatus.FAILED
+            self._resolve_request(queue_id, RequestStatus.FAILED, data=[])
             print(
                 "[" + CommunicationChannel.QUART_SERVER + "] Something went wrong with a weather request: " + e.__str__())
 
@@ -695,7 +928,7 @@ class ConnectionController(object):
         params = {"country": loc["country"].lower(), "apiKey": os.getenv("NEWS_DATA_KEY"), "pageSize": 10}
         url = "https://newsapi.org/v2/top-headlines"
 
-        self._data_queue[queue_id] = {"status": RequestStatus.PENDING, "requested_at": start_time}
+        self._queue_request(queue_id, start_time)
         self.save_to_history(channel=CommunicationChannel.EXTERNAL, user=user_id, tablet=tablet_id, message_in="",
                              message_out="news_request", start_time=start_time)
         success = False
@@ -703,15 +936,13 @@ class ConnectionController(object):
             resp = await self._external_api.get(url, params=params)
             response = await resp.json()
             if "status" not in response or str(response["status"]) != "ok":
-                self._data_queue[queue_id]["status"] = RequestStatus.FAILED
-                self._data_queue[queue_id]["data"] = []
+                self._resolve_request(queue_id, RequestStatus.FAILED, data=[])
             else:
-                self._data_queue[queue_id]["status"] = RequestStatus.RECEIVED
-                self._data_queue[queue_id]["data"] = response
+                self._resolve_request(queue_id, RequestStatus.RECEIVED, data=response)
                 success = True
 
         except Exception as e:
-            self._data_queue[queue_id]["status"] = RequestStatus.FAILED
+            self._resolve_request(queue_id, RequestStatus.FAILED, data=[])
             print(
                 "[" + CommunicationChannel.QUART_SERVER + "] Something went wrong with a news request: " + e.__str__())
 
@@ -732,27 +963,35 @@ class ConnectionController(object):
         params = {"q": location, "appid": os.getenv("WEATHER_API_KEY"), "lang": lang, "limit": 1}
         url = "http://api.openweathermap.org/geo/1.0/direct"
 
-        self._data_queue[queue_id] = {"status": RequestStatus.PENDING, "requested_at": start_time}
+        self._queue_request(queue_id, start_time)
         self.save_to_history(channel=CommunicationChannel.EXTERNAL, user="", tablet="", message_in="",
                              message_out="geocode_request", start_time=start_time)
         success = False
         try:
             resp = await self._external_api.get(url, params=params)
             response = await resp.json()
-            self._data_queue[queue_id]["status"] = RequestStatus.RECEIVED
-            self._data_queue[queue_id]["data"] = response
+            self._resolve_request(queue_id, RequestStatus.RECEIVED, data=response)
             success = True
 
         except Exception as e:
-            self._data_queue[queue_id]["status"] = RequestStatus.FAILED
+            self._resolve_request(queue_id, RequestStatus.FAILED, data=[])
             print(
                 "[" + CommunicationChannel.QUART_SERVER + "] Something went wrong with a geocode request: " + e.__str__())
 
         self.save_to_history(channel=CommunicationChannel.EXTERNAL, user="", tablet="",
                              message_in="geocode_data",
                              message_out=self._data_queue[queue_id]["status"], start_time=start_time)
+        if success:  # the waiters have their data, store it for next time in the background
+            self.add_background_task(self._learn_geocode, location, response)
         return {"success": success, "id": queue_id}
 
+    async def _learn_geocode(self, location: str, places):
+        try:
+            await asyncio.to_thread(self._gazetteer.learn, location, places)
+        except Exception as e:
+            print("[" + CommunicationChannel.QUART_SERVER + "] Could not store the geocode of " + location + ": " +
+                  e.__str__())
+
     async def _handle_conversation_request(self, data: dict):
         if data["type"] == "message_shown":
             return
@@ -778,7 +1017,7 @@ class ConnectionController(object):
         start_time = datetime.utcnow()
         tablet_id = data["client"]["id"]
         if tablet_id not in self._data_queue:
-            self._data_queue[tablet_id] = {"status": RequestStatus.PENDING}
+            self._queue_request(tablet_id, start_time)
             self.save_to_history(channel=CommunicationChannel.LIZZ_API, user="", tablet=tablet_id,
                                  message_in="tablet_user_data",
                                  message_out="[WARNING] Received data for id that was not in queue.",
@@ -791,7 +1030,7 @@ class ConnectionController(object):
             if "user" in data["data"]:
                 user_data = data["data"]["user"]
             if not user_data:
-                self._data_queue[tablet_id]["status"] = RequestStatus.FAILED
+                self._resolve_request(tablet_id, RequestStatus.FAILED)
 
                 print(
                     "[" + CommunicationChannel.LIZZ_API + " (IN)] Received empty user data from tablet with id: " + tablet_id)
@@ -821,13 +1060,13 @@ class ConnectionController(object):
             if "language" in user_data:
                 self._data_queue[tablet_id]["data"]["CLIENT-LANG"] = lang_map[user_data["language"].lower()]
 
-            self._data_queue[tablet_id]["status"] = RequestStatus.RECEIVED
+            self._resolve_request(tablet_id, RequestStatus.RECEIVED)
             print("[" + CommunicationChannel.LIZZ_API + " (IN)] Received user data from tablet with id: " + tablet_id)
             self.save_to_history(channel=CommunicationChannel.LIZZ_API, user=user_data["id"], tablet=tablet_id,
                                  message_in="tablet_user_data",
                                  message_out=self._data_queue[tablet_id]["status"], start_time=start_time)
         except Exception as e:
-            self._data_queue[tablet_id]["status"] = RequestStatus.FAILED
+            self._resolve_request(tablet_id, RequestStatus.FAILED)
 
             print(
                 "[" + CommunicationChannel.LIZZ_API + " (IN)] Error: " + e.__str__())
@@ -843,7 +1082,7 @@ class ConnectionController(object):
         day = data["data"]["day"]
         queue_id = tablet_id + RequestAppend.CALENDAR + day
         if queue_id not in self._data_queue:
-            self._data_queue[queue_id] = {"status": RequestStatus.PENDING}
+            self._queue_request(queue_id, start_time)
             self.save_to_history(channel=CommunicationChannel.LIZZ_API, user="", tablet=tablet_id,
                                  message_in="tablet_calendar_data",
                                  message_out="[WARNING] Received data for id that was not in queue.",
@@ -857,24 +1096,15 @@ class ConnectionController(object):
             if "calendar" in data["data"]:
                 calendar_data = data["data"]["calendar"]
             self._data_queue[queue_id]["data"] = calendar_data
-            if not calendar_data:
-                self._data_queue[queue_id]["status"] = RequestStatus.FAILED
-                print(
-                    "[" + CommunicationChannel.LIZZ_API + " (IN)] Received empty calendar data from tablet with id: " + tablet_id)
-                self.save_to_history(channel=CommunicationChannel.LIZZ_API, user=user_id, tablet=tablet_id,
-                                     message_in="tablet_calendar_data",
-                                     message_out=self._data_queue[queue_id]["status"], start_time=start_time)
-                return False
-
-            self._data_queue[queue_id]["status"] = RequestStatus.RECEIVED
-            print(
-                "[" + CommunicationChannel.LIZZ_API + " (IN)] Received calendar data from tablet with id: " + tablet_id)
+            self._resolve_request(queue_id, RequestStatus.RECEIVED)  # an empty calendar is an answer too, keep it
+            print("[" + CommunicationChannel.LIZZ_API + " (IN)] Received " + ("" if calendar_data else "empty ") +
+                  "calendar data from tablet with id: " + tablet_id)
             self.save_to_history(channel=CommunicationChannel.LIZZ_API, user=user_id, tablet=tablet_id,
                                  message_in="tablet_calendar_data",
                                  message_out=self._data_queue[queue_id]["status"], start_time=start_time)
 
         except Exception as e:
-            self._data_queue[tablet_id]["status"] = RequestStatus.FAILED
+            self._resolve_request(queue_id, RequestStatus.FAILED)
 
             print(
                 "[" + CommunicationChannel.LIZZ_API + " (IN)] Error: " + e.__str__())
@@ -889,7 +1119,7 @@ class ConnectionController(object):
         tablet_id = data["client"]["id"]
         queue_id = tablet_id + RequestAppend.REPORT + start_time.strftime("%Y-%m-%d")
         if queue_id not in self._data_queue:
-            self._data_queue[queue_id] = {"status": RequestStatus.PENDING}
+            self._queue_request(queue_id, start_time)
             self.save_to_history(channel=CommunicationChannel.LIZZ_API, user="", tablet=tablet_id,
                                  message_in="tablet_report_data",
                                  message_out="[WARNING] Received data for id that was not in queue.",
@@ -906,24 +1136,15 @@ class ConnectionController(object):
                 configs_time = data["data"]["reminderConfigsAndTime"]
 
             self._data_queue[queue_id]["data"] = {"last_24h": report_data, "future": configs_time}
-
-            if not report_data:
-                self._data_queue[queue_id]["status"] = RequestStatus.FAILED
-                print(
-                    "[" + CommunicationChannel.LIZZ_API + " (IN)] Received empty report data from tablet with id: " + tablet_id)
-                self.save_to_history(channel=CommunicationChannel.LIZZ_API, user=user_id, tablet=tablet_id,
-                                     message_in="tablet_report_data",
-                                     message_out=self._data_queue[queue_id]["status"], start_time=start_time)
-                return False
-
-            self._data_queue[queue_id]["status"] = RequestStatus.RECEIVED
-            print("[" + CommunicationChannel.LIZZ_API + " (IN)] Received report data from tablet with id: " + tablet_id)
+            self._resolve_request(queue_id, RequestStatus.RECEIVED)  # no reports in the last 24 hours is an answer too
+            print("[" + CommunicationChannel.LIZZ_API + " (IN)] Received " + ("" if report_data else "empty ") +
+                  "report data from tablet with id: " + tablet_id)
             self.save_to_history(channel=CommunicationChannel.LIZZ_API, user=user_id, tablet=tablet_id,
                                  message_in="tablet_report_data",
                                  message_out=self._data_queue[queue_id]["status"], start_time=start_time)
 
         except Exception as e:
-            self._data_queue[tablet_id]["status"] = RequestStatus.FAILED
+            self._resolve_request(queue_id, RequestStatus.FAILED)
 
             print(
                 "[" + CommunicationChannel.LIZZ_API + " (IN)] Error: " + e.__str__())
@@ -933,112 +1154,107 @@ class ConnectionController(object):
             return False
         return True
 
-    async def get_client_data(self, tablet_id: str, interval=0.5, refresh_time_mins=60):
-        # first check if this data is already known in the session, no need to pull it again unless its time to refresh
-        time_since_refresh = datetime.utcnow() - timedelta(minutes=refresh_time_mins)
-        if tablet_id not in self._data_queue or self._data_queue[tablet_id]["status"] == RequestStatus.FAILED or \
-                self._data_queue[tablet_id]["requested_at"] < time_since_refresh:
-            await self._request_tablet_user_data(tablet_id)  # if necessary, send a request
-        while self._data_queue[tablet_id]["status"] == RequestStatus.PENDING:
-            await asyncio.sleep(interval)  # await the request response
-
-        return copy.deepcopy(self._data_queue[tablet_id]["data"])
+    async def _get_data(self, queue_id: str, refresh_time_mins, request, *args, **kwargs):
+        # concurrent callers for the same key share the request that is already in flight
+        if queue_id in self._in_flight:
+            return copy.deepcopy(await asyncio.shield(self._in_flight[queue_id]))
 
-    async def get_calendar_data(self, tablet_id: str, day: datetime, interval=0.5, refresh_time_mins=5):
         # first check if this data is already known in the session, no need to pull it again unless its time to refresh
-        time_since_refresh = datetime.utcnow() - timedelta(minutes=refresh_time_mins)
-        queue_id = tablet_id + RequestAppend.CALENDAR + day.strftime("%Y-%m-%d")
-
-        if queue_id not in self._data_queue or self._data_queue[queue_id]["status"] == RequestStatus.FAILED or \
-                self._data_queue[queue_id]["requested_at"] < time_since_refresh:
-            await self._request_tablet_calendar_data(tablet_id, day)  # if necessary, send a request
+        entry = self._data_queue.lookup(queue_id, ttl_mins=refresh_time_mins)
+        if entry is None or entry["status"] == RequestStatus.FAILED:
+            flight = asyncio.ensure_future(self._request_and_await(queue_id, request, *args, **kwargs))
+            self._in_flight[queue_id] = flight
+            return copy.deepcopy(await asyncio.shield(flight))  # shielded, one cancelled caller won't fail the rest
 
-        while self._data_queue[queue_id]["status"] == RequestStatus.PENDING:
-            await asyncio.sleep(interval)  # await the request response
+        return copy.deepcopy(await self._await_request(queue_id))  # await the request response
 
-        return copy.deepcopy(self._data_queue[queue_id]["data"])
+    async def _request_and_await(self, queue_id: str, request, *args, **kwargs):
+        try:
+            await request(*args, **kwargs)  # if necessary, send a request
+            return await self._await_request(queue_id)
+        finally:
+            self._in_flight.pop(queue_id, None)
 
-    async def get_report_data(self, tablet_id: str, day: datetime, lookback_hours=24, interval=0.5,
-                              refresh_time_mins=1):
-        # first check if this data is already known in the session, no need to pull it again unless its time to refresh
-        time_since_refresh = datetime.utcnow() - timedelta(minutes=refresh_time_mins)
-        queue_id = tablet_id + RequestAppend.REPORT + day.strftime("%Y-%m-%d")
+    async def warm_up(self, tablet_id: str):
+        """
+        Prefetch the data a conversation with this tablet is likely to need, so the first turn hits a warm cache.
+        Only the data that stays in the cache for at least WARM_UP_MIN_TTL_MINS is prefetched.
+        """
+        start_time = datetime.utcnow()
+        try:
+            client_data = await self.get_client_data(tablet_id)
+            lang = client_data.get("CLIENT-LANG", "nl")
+            location = client_data["CLIENT-LOCATION-CITY"] + ", " + client_data["CLIENT-LOCATION-COUNTRY"]
+            sources = {CacheNamespace.GEOCODE: lambda: self.get_geocode_data(location, lang=lang),
+                       CacheNamespace.WEATHER_NOW: lambda: self.get_weather_now_data(tablet_id, lang=lang),
+                       CacheNamespace.WEATHER_FORECAST: lambda: self.get_weather_forecast_data(tablet_id, lang=lang),
+                       CacheNamespace.NEWS: lambda: self.get_news_data(tablet_id, lang=lang),
+                       CacheNamespace.CALENDAR: lambda: self.get_calendar_data(tablet_id, day=start_time),
+                       CacheNamespace.REPORT: lambda: self.get_report_data(tablet_id, day=start_time)}
+            results = await asyncio.gather(*[fetch() for namespace, fetch in sources.items()
+                                             if CACHE_TTL_MINS[namespace] >= WARM_UP_MIN_TTL_MINS],
+                                           return_exceptions=True)
+            failed = [r for r in results if isinstance(r, Exception)]
+            message_out = "completed" if not failed else "failed " + str(len(failed)) + " of " + str(len(results))
+        except Exception as e:
+            message_out = "error, failed to warm up: " + e.__str__()
+        self.save_to_history(channel=CommunicationChannel.QUART_SERVER, tablet=tablet_id,
+                             message_in="warm_up", message_out=message_out, start_time=start_time)
 
-        if queue_id not in self._data_queue or self._data_queue[queue_id]["status"] == RequestStatus.FAILED or \
-                self._data_queue[queue_id]["requested_at"] < time_since_refresh:
-            await self._request_tablet_report_data(tablet_id, day, lookback_hours)  # if necessary, send a request
+    async def get_client_data(self, tablet_id: str, refresh_time_mins=None):
+        return await self._get_data(tablet_id, refresh_time_mins, self._request_tablet_user_data, tablet_id)
 
-        while self._data_queue[queue_id]["status"] == RequestStatus.PENDING:
-            await asyncio.sleep(interval)  # await the request response
+    async def get_calendar_data(self, tablet_id: str, day: datetime, refresh_time_mins=None):
+        queue_id = tablet_id + RequestAppend.CALENDAR + day.strftime("%Y-%m-%d")
+        return await self._get_data(queue_id, refresh_time_mins, self._request_tablet_calendar_data, tablet_id, day)
 
-        return copy.deepcopy(self._data_queue[queue_id]["data"])
+    async def get_report_data(self, tablet_id: str, day: datetime, lookback_hours=24, refresh_time_mins=None):
+        queue_id = tablet_id + RequestAppend.REPORT + day.strftime("%Y-%m-%d")
+        return await self._get_data(queue_id, refresh_time_mins, self._request_tablet_report_data, tablet_id, day,
+                                    lookback_hours)
 
-    async def get_weather_now_data(self, tablet_id: str, lang="en", interval=0.5, refresh_time_mins=5):
-        # first check if this data is already known in the session, no need to pull it again unless its time to refresh
-        time_since_refresh = datetime.utcnow() - timedelta(minutes=refresh_time_mins)
+    async def get_weather_now_data(self, tablet_id: str, lang="en", refresh_time_mins=None):
         request_type = WeatherRequest.NOW
         queue_id = tablet_id + RequestAppend.WEATHER + str(request_type)
-        if queue_id not in self._data_queue or self._data_queue[queue_id]["status"] == RequestStatus.FAILED or \
-                self._data_queue[queue_id]["requested_at"] < time_since_refresh:
-            await self._request_weather_data(tablet_id, request_type=request_type,
-                                             lang=lang)  # if necessary, send a request
+        return await self._get_data(queue_id, refresh_time_mins, self._request_weather_data, tablet_id,
+                                    request_type=request_type, lang=lang)
 
-        while self._data_queue[queue_id]["status"] == RequestStatus.PENDING:
-            await asyncio.sleep(interval)  # await the request response
-
-        return copy.deepcopy(self._data_queue[queue_id]["data"])
-
-    async def get_weather_forecast_data(self, tablet_id: str, lang="en", interval=0.5, refresh_time_mins=0.5):
-        # first check if this data is already known in the session, no need to pull it again unless its time to refresh
-        time_since_refresh = datetime.utcnow() - timedelta(minutes=refresh_time_mins)
+    async def get_weather_forecast_data(self, tablet_id: str, lang="en", refresh_time_mins=None):
         request_type = WeatherRequest.FORECAST
         queue_id = tablet_id + RequestAppend.WEATHER + str(request_type)
-        if queue_id not in self._data_queue or self._data_queue[queue_id]["status"] == RequestStatus.FAILED or \
-                self._data_queue[queue_id]["requested_at"] < time_since_refresh:
-            await self._request_weather_data(tablet_id, request_type=request_type,
-                                             lang=lang)  # if necessary, send a request
-
-        while self._data_queue[queue_id]["status"] == RequestStatus.PENDING:
-            await asyncio.sleep(interval)  # await the request response
+        return await self._get_data(queue_id, refresh_time_mins, self._request_weather_data, tablet_id,
+                                    request_type=request_type, lang=lang)
 
-        return copy.deepcopy(self._data_queue[queue_id]["data"])
-
-    async def get_geocode_data(self, location: str, lang="en", interval=0.5, refresh_time_mins=180):
-        # first check if this data is already known in the session, no need to pull it again unless its time to refresh
-        time_since_refresh = datetime.utcnow() - timedelta(minutes=refresh_time_mins)
+    async def get_geocode_data(self, location: str, lang="en", refresh_time_mins=None):
+        places = self._gazetteer.lookup(location)
+        if places is not None:
+            return places
         queue_id = RequestPrepend.GEOCODE + location
-        if queue_id not in self._data_queue or self._data_queue[queue_id]["status"] == RequestStatus.FAILED or \
-                self._data_queue[queue_id]["requested_at"] < time_since_refresh:
-            await self._request_geocode_data(location, lang=lang)  # if necessary, send a request
-
-        while self._data_queue[queue_id]["status"] == RequestStatus.PENDING:
-            await asyncio.sleep(interval)  # await the request response
-
-        return copy.deepcopy(self._data_queue[queue_id]["data"])
+        return await self._get_data(queue_id, refresh_time_mins, self._request_geocode_data, location, lang=lang)
 
-    async def get_news_data(self, tablet_id: str, lang="en", interval=0.5, refresh_time_mins=5):
-        # first check if this data is already known in the session, no need to pull it again unless its time to refresh
-        time_since_refresh = datetime.utcnow() - timedelta(minutes=refresh_time_mins)
+    async def get_news_data(self, tablet_id: str, lang="en", refresh_time_mins=None):
         queue_id = tablet_id + RequestAppend.NEWS
-        if queue_id not in self._data_queue or self._data_queue[queue_id]["status"] == RequestStatus.FAILED or \
-                self._data_queue[queue_id]["requested_at"] < time_since_refresh:
-            await self._request_news_data(tablet_id, lang=lang)  # if necessary, send a request
-
-        while self._data_queue[queue_id]["status"] == RequestStatus.PENDING:
-            await asyncio.sleep(interval)  # await the request response
+        return await self._get_data(queue_id, refresh_time_mins, self._request_news_data, tablet_id, lang=lang)
 
-        return copy.deepcopy(self._data_queue[queue_id]["data"])
+    async def complete_with_gpt(self, messages: list, on_first_sentence=None):
+        """
+        Complete the conversation as a JSON object with a 'message' field.
+        With on_first_sentence the completion is streamed, and on_first_sentence(sentence) is called with the first
+        sentence of the message as soon as it is complete. The completion is returned once the call has finished.
+        """
+        if on_first_sentence:
+            return await self._stream_with_gpt(messages, on_first_sentence)
 
-    async def complete_with_gpt(self, messages: list):
         start_time = datetime.utcnow()
         print("[" + CommunicationChannel.OPENAI_API + "] Awaiting completion GPT...")
 
-        completion = await self._openai_api.chat.completions.create(
-            model="gpt-4o",
+        completion = await self._openai_calls.call(GPT_MODEL, lambda: self._openai_api.chat.completions.create(
+            model=GPT_MODEL,
             response_format={"type": "json_object"},
             messages=messages,
             temperature=0.7
-        )
+        ), deadline=GPT_DEADLINE)
+        self._record_gpt_usage(completion.usage, start_time)
         content = completion.choices[0].message.content
         content = content.strip("```").strip("json")
         self.save_to_history(channel=CommunicationChannel.OPENAI_API, user="", tablet="",
@@ -1047,16 +1263,105 @@ class ConnectionController(object):
         data = json.loads(content)
         return data
 
+    async def _stream_with_gpt(self, messages: list, on_first_sentence):
+        start_time = datetime.utcnow()
+        print("[" + CommunicationChannel.OPENAI_API + "] Streaming completion GPT...")
+
+        delivery = None
+
+        async def stream_completion():
+            nonlocal delivery
+            stream = await self._openai_api.chat.completions.create(
+                model=GPT_MODEL,
+                response_format={"type": "json_object"},
+                messages=messages,
+                temperature=0.7,
+                stream=True,
+                stream_options={"include_usage": True}
+            )
+            content, extractor = [], JsonFieldExtractor("message")
+            async for chunk in stream:
+                if chunk.usage:  # sent in the last chunk
+                    self._record_gpt_usage(chunk.usage, start_time)
+                if not chunk.choices or not chunk.choices[0].delta.content:
+                    continue
+                content.append(chunk.choices[0].delta.content)
+                if delivery is None and extractor.feed(content[-1]):
+                    sentence = first_sentence(extractor.value.lstrip())
+                    if sentence:  # deliver it while the rest is still coming in
+                        delivery = asyncio.ensure_future(on_first_sentence(sentence))
+                        self.save_to_history(channel=CommunicationChannel.OPENAI_API, user="", tablet="",
+                                             message_in="complete_with_gpt", message_out="first_sentence",
+                                             start_time=start_time)
+            return content
+
+        try:
+            # a retry would be a different completion that does not start with the sentence the tablet is speaking
+            content = await self._openai_calls.call(GPT_MODEL, stream_completion, deadline=GPT_DEADLINE,
+                                                    may_retry=lambda: delivery is None)
+        finally:
+            if delivery is not None:
+                try:
+                    await delivery  # the first sentence has to go out before the complete message
+                except Exception as e:
+                    print("[" + CommunicationChannel.OPENAI_API + "] Could not deliver the first sentence: " +
+                          e.__str__())
+
+        content = "".join(content).strip("```").strip("json")
+        self.save_to_history(channel=CommunicationChannel.OPENAI_API, user="", tablet="",
+                             message_in="complete_with_gpt",
+                             message_out="completed", start_time=start_time)
+        return json.loads(content)
+
+    def _record_gpt_usage(self, usage, start_time: datetime):
+        if not usage:
+            return
+        details = getattr(usage, "prompt_tokens_details", None)
+        self._gpt_usage["completions"] += 1
+        self._gpt_usage["prompt_tokens"] += usage.prompt_tokens
+        self._gpt_usage["cached_tokens"] += (details.cached_tokens or 0) if details else 0
+        self._gpt_usage["completion_tokens"] += usage.completion_tokens
+        self._gpt_usage["seconds"] += (datetime.utcnow() - start_time).total_seconds()
+
+    def gpt_stats(self):
+        usage = self._gpt_usage
+        return dict(usage,
+                    cached_ratio=usage["cached_tokens"] / usage["prompt_tokens"] if usage["prompt_tokens"] else 0,
+                    avg_seconds=usage["seconds"] / usage["completions"] if usage["completions"] else 0)
+
+    def openai_stats(self):
+        return self._openai_calls.stats()
+
+    def transcription_stats(self):
+        return self._transcription.stats()
+
+    def gazetteer_stats(self):
+        return self._gazetteer.stats()
+
+    async def send_partial_response(self, client: dict, text: str):
+        """
+        Show (and speak) the start of a response while the rest is still being generated
+        """
+        start_time = datetime.utcnow()
+        self.save_to_history(channel=CommunicationChannel.LIZZ_API, tablet=client["id"],
+                             message_in="", message_out=text, start_time=start_time)
+        await self._api_writer.send(envelope.partial_message(client, text), SendPriority.HIGH)
+
     async def transcribe_with_whisper(self, audio):
         start_time = datetime.utcnow()
         print("[" + CommunicationChannel.OPENAI_API + "] Awaiting completion Whisper...")
 
-        transcription = await self._openai_api.audio.transcriptions.create(
-            model="whisper-1",
-            file=audio,
-            language="nl",
-            prompt="Mwah, Slecht, Prima, Goed, Erg goed, Het gaat wel, Redelijk, Belabberd, Super, Niet zo goed, Het gaat slecht, Geslapen"
-        )
+        async def transcribe():
+            if hasattr(audio, "seek"):
+                audio.seek(0)  # read the audio from the start again on a retry
+            return await self._openai_api.audio.transcriptions.create(
+                model=WHISPER_MODEL,
+                file=audio,
+                language="nl",
+                prompt="Mwah, Slecht, Prima, Goed, Erg goed, Het gaat wel, Redelijk, Belabberd, Super, Niet zo goed, Het gaat slecht, Geslapen"
+            )
+
+        transcription = await self._openai_calls.call(WHISPER_MODEL, transcribe, deadline=WHISPER_DEADLINE)
         text_in = transcription.text
         self.save_to_history(channel=CommunicationChannel.OPENAI_API, user="", tablet="",
                              message_in="transcribe_with_whisper",
@@ -1064,49 +1369,37 @@ class ConnectionController(object):
         return text_in
 
     async def listen_to_audio(self, record_seconds=RECORD_SECONDS):
+        """
+        Record from the audio source without blocking the event loop until the user is done speaking (at most
+        record_seconds). The speech is transcribed while recording, returns after the recording with the task that
+        finishes with the transcript.
+        """
         await asyncio.sleep(0.5)
         start_time = datetime.utcnow()
-        audio = pyaudio.PyAudio()
-
-        stream = audio.open(
-            format=FORMAT,
-            channels=CHANNELS,
-            rate=RATE,
-            input=True,
-            frames_per_buffer=CHUNK,
-        )
-
-        frames = []
-
-        for i in range(0, int(RATE / CHUNK * record_seconds)):
-            data = stream.read(CHUNK)
-            frames.append(data)
 
-        stream.close()
-        audio.terminate()
-
-        waveFile = wave.open(WAVE_OUTPUT_FILENAME, "wb")
-        waveFile.setnchannels(CHANNELS)
-        waveFile.setsampwidth(audio.get_sample_size(FORMAT))
-        waveFile.setframerate(RATE)
-        waveFile.writeframes(b''.join(frames))
-        waveFile.close()
-
-        audio = open(WAVE_OUTPUT_FILENAME, "rb")
+        detector = VoiceActivityDetector(trailing_silence=LISTEN_TRAILING_SILENCE, min_seconds=LISTEN_MIN_SECONDS)
+        capture = AudioCapture(self.audio_source, max_seconds=record_seconds, detector=detector)
+        transcription = asyncio.create_task(self._transcription.run(capture))
+        try:
+            await capture.record(record_seconds)
+        except BaseException:
+            transcription.cancel()
+            raise
 
         self.save_to_history(channel=CommunicationChannel.LIZZ_API, user="", tablet="",
                              message_in="listen_to_audio",
-                             message_out="completed", start_time=start_time)
+                             message_out="completed after %.1f seconds" % capture.seconds, start_time=start_time)
 
-        return audio
+        return transcription
 
     async def get_gpt_history(self, tablet_id: str):
-        if tablet_id in self._gpt_history:
-            return copy.deepcopy(self._gpt_history[tablet_id])
-        else:
-            return []
+        """
+        The conversation so far, a read-only view that supports len, indexing and slicing (like a list of turns)
+        """
+        return self._gpt_sessions.history(tablet_id)
 
     async def save_gpt_history(self, tablet_id: str, role: str, message: str):
-        if not tablet_id in self._gpt_history:
-            self._gpt_history[tablet_id] = []
-        self._gpt_history[tablet_id].append({"role": role, "content": message})
+        self._gpt_sessions.append(tablet_id, role, message)
+
+    def session_stats(self):
+        return self._gpt_sessions.stats()
@@ -0,0 +1,128 @@
+import json
+import time
+from collections import OrderedDict
+
+
+def _estimate_size(entry: dict):
+    try:
+        return len(json.dumps(entry.get("data"), default=str))
+    except Exception as e:
+        return 0
+
+
+class DataCache(object):
+    """
+    Bounded store for the data requested from Lizz and external APIs.
+    Entries expire after the TTL of their namespace. Expired entries are dropped while storing, at most every
+    purge_secs seconds, and once the entry or byte budget is exceeded, so the cache holds about the live entries.
+    When that is not enough the least recently used entries are evicted.
+    Entries for which evictable(entry) is False (e.g. pending requests) are never dropped.
+    """
+
+    def __init__(self, ttl_mins: dict, namespace_of, evictable=None, max_entries=4096, max_bytes=16 * 1024 * 1024,
+                 purge_secs=60):
+        self.ttl_mins = ttl_mins  # {namespace : minutes}
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.purge_secs = purge_secs
+        self._namespace_of = namespace_of
+        self._evictable = evictable if evictable else lambda entry: True
+
+        self._entries = OrderedDict()  # {key : entry}, least recently used first
+        self._stored_at = {}  # {key : monotonic time of storing}
+        self._sizes = {}  # {key : estimated size of the data in bytes}
+        self._bytes = 0
+        self._purged_at = time.monotonic()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def __getitem__(self, key):
+        return self._entries[key]
+
+    def get(self, key, default=None):
+        return self._entries.get(key, default)
+
+    def __setitem__(self, key, entry: dict):
+        self._forget(key)
+        self._entries[key] = entry
+        self._stored_at[key] = time.monotonic()
+        self._sizes[key] = _estimate_size(entry)
+        self._bytes += self._sizes[key]
+        self._enforce_budget(keep=key)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _forget(self, key):
+        if key in self._entries:
+            del self._entries[key]
+            del self._stored_at[key]
+            self._bytes -= self._sizes.pop(key)
+
+    def _expired(self, key, ttl_mins=None):
+        if ttl_mins is None:
+            ttl_mins = self.ttl_mins.get(self._namespace_of(key), 0)
+        return time.monotonic() - self._stored_at[key] > ttl_mins * 60
+
+    def lookup(self, key, ttl_mins=None):
+        """
+        Return the entry if it is known and has not expired yet, else None
+        """
+        if key not in self._entries or self._expired(key, ttl_mins):
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._entries.move_to_end(key)
+        return self._entries[key]
+
+    def measure(self, key):
+        """
+        Update the size of an entry after its data was filled in, the entry itself is not evicted to make room
+        """
+        if key not in self._entries:
+            return
+        self._entries.move_to_end(key)
+        self._bytes -= self._sizes[key]
+        self._sizes[key] = _estimate_size(self._entries[key])
+        self._bytes += self._sizes[key]
+        self._enforce_budget(keep=key)
+
+    def _purge_expired(self, keep=None):
+        self._purged_at = time.monotonic()
+        expired = [key for key, entry in self._entries.items()
+                   if key != keep and self._expired(key) and self._evictable(entry)]
+        for key in expired:
+            self.expirations += 1
+            self._forget(key)
+
+    def _enforce_budget(self, keep=None):
+        over_budget = len(self._entries) > self.max_entries or self._bytes > self.max_bytes
+        if over_budget or time.monotonic() - self._purged_at >= self.purge_secs:
+            self._purge_expired(keep)
+
+        entries, size, victims = len(self._entries), self._bytes, []
+        for key, entry in self._entries.items():  # least recently used first
+            if entries <= self.max_entries and size <= self.max_bytes:
+                break
+            if key != keep and self._evictable(entry):
+                victims.append(key)
+                entries -= 1
+                size -= self._sizes[key]
+
+        for key in victims:
+            self.evictions += 1
+            self._forget(key)
+
+    def stats(self):
+        return {"entries": len(self._entries),
+                "bytes": self._bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations}
@@ -0,0 +1,57 @@
+import json
+
+from generators import emote
+
+"""
+Outgoing messages keep 'extra' in their data as a dict, Lizz expects it as a JSON string inside the message.
+It is only encoded here, together with the rest of the message, right before the message is sent.
+"""
+
+DEFAULT_EMOTES = emote.get_emotes_from_keys({})
+DEFAULT_EXTRA = json.dumps(DEFAULT_EMOTES)  # pre-serialized, most messages use the default emotes
+
+TYPING_DATA = json.dumps({"message": "...",
+                          "messageTts": "   ",
+                          "message_id": "is-typing",
+                          "buttons": [],
+                          "extra": DEFAULT_EXTRA,
+                          "listen": "manual"})  # pre-serialized, sent before every response
+
+
+def encode_extra(extra):
+    if isinstance(extra, str):
+        return extra
+    if extra == DEFAULT_EMOTES:  # by value, cheap as the routines are shared and compare by identity first
+        return DEFAULT_EXTRA
+    return json.dumps(extra)
+
+
+def encode(message: dict):
+    """
+    Serialize an outgoing message, including the 'extra' in its data
+    """
+    data = message.get("data")
+    if isinstance(data, dict) and "extra" in data:
+        data = dict(data, extra=encode_extra(data["extra"]))
+        message = dict(message, data=data)
+    return json.dumps(message)
+
+
+def typing_message(client: dict):
+    """
+    The 'is typing' message that is shown while the response is generated
+    """
+    return '{"type": "external_interaction_message", "data": ' + TYPING_DATA + ', "client": ' + json.dumps(client) + '}'
+
+
+def partial_message(client: dict, text: str):
+    """
+    Like the 'is typing' message, but showing (and speaking) the first part of the response
+    """
+    message_data = {"message": text,
+                    "messageTts": text,
+                    "message_id": "is-typing",
+                    "buttons": [],
+                    "extra": DEFAULT_EXTRA,
+                    "listen": "manual"}
+    return json.dumps({"type": "external_interaction_message", "data": message_data, "client": client})
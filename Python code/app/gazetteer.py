@@ -0,0 +1,170 @@
+import csv
+import glob
+import os
+import re
+import threading
+import unicodedata
+
+import numpy as np
+
+KEY_SIZE = 64  # bytes, longer locations are not stored
+
+# one fixed size record per place, sorted by key so a lookup is a binary search over the memory-mapped table
+RECORD = np.dtype([("key", "S" + str(KEY_SIZE)),
+                   ("name", "S48"),
+                   ("state", "S32"),
+                   ("country", "S2"),
+                   ("lat", "<f8"),
+                   ("lon", "<f8")])
+
+COUNTRY_CODES = {"nederland": "NL", "netherlands": "NL", "the netherlands": "NL", "holland": "NL", "nl": "NL",
+                 "belgie": "BE", "belgium": "BE", "be": "BE",
+                 "duitsland": "DE", "germany": "DE", "deutschland": "DE", "de": "DE"}
+
+LEARNED_COLUMNS = ["location", "name", "state", "country", "lat", "lon"]
+
+
+def normalize(name: str):
+    """
+    Lower case, without accents, punctuation or double spaces: "'s-Hertogenbosch " becomes "s hertogenbosch"
+    """
+    name = unicodedata.normalize("NFKD", name)
+    name = "".join(c for c in name if not unicodedata.combining(c))
+    return " ".join(re.findall(r"\w+", name.lower()))
+
+
+def location_key(location: str):
+    """
+    The key of a "city, country" location, the country as a country code where it is known
+    """
+    city, _, country = location.rpartition(",") if "," in location else (location, "", "")
+    country = normalize(country)
+    return normalize(city) + "," + COUNTRY_CODES.get(country, country).lower()
+
+
+def _text(value: bytes):
+    return value.decode("utf-8", errors="ignore")  # a name cut off by the record size may end halfway a character
+
+
+class Gazetteer(object):
+    """
+    Local geocoding of tablet locations. The places come from the seed tables (config/gazetteer/*.tsv, one row per
+    place or alias) and from remote lookups that were learned before (learned_file). Both are compiled into table_file,
+    a sorted table of fixed size records that is memory-mapped, so only the pages a lookup touches are read.
+    Lookups return the places in the format of the OpenWeather geocoding API.
+    """
+
+    def __init__(self, seed_files="config/gazetteer/*.tsv", learned_file="data/gazetteer-learned.tsv",
+                 table_file="data/gazetteer.dat"):
+        self.seed_files = sorted(glob.glob(seed_files))
+        self.learned_file = learned_file
+        self.table_file = table_file
+
+        self._index = None  # (table, keys of the table), replaced as a whole so lookups never mix two tables
+        self._use(np.zeros(0, dtype=RECORD))
+        self._lock = threading.Lock()  # learning happens off the event loop, one place at a time
+
+        self.hits = 0
+        self.misses = 0
+        self.learned = 0
+
+        self._load()
+
+    def _sources(self):
+        return self.seed_files + ([self.learned_file] if os.path.exists(self.learned_file) else [])
+
+    def _load(self):
+        try:
+            if os.path.getmtime(self.table_file) >= max(os.path.getmtime(f) for f in self._sources()):
+                self._use(np.memmap(self.table_file, dtype=RECORD, mode="r"))
+                return
+        except (OSError, ValueError):
+            pass
+        self._compile()
+
+    def _rows(self):
+        for filename in self.seed_files:
+            with open(filename, newline="", encoding="utf-8") as f:
+                for row in csv.DictReader(f, delimiter="\t"):
+                    yield location_key(row["name"] + "," + row["country"]), row
+        if os.path.exists(self.learned_file):
+            with open(self.learned_file, newline="", encoding="utf-8") as f:
+                for row in csv.DictReader(f, delimiter="\t", fieldnames=LEARNED_COLUMNS):
+                    yield location_key(row["location"]), row
+
+    def _compile(self):
+        places = {}
+        for key, row in self._rows():
+            places.setdefault(key, row)  # the seed tables go first
+        table = np.zeros(len(places), dtype=RECORD)
+        for i, key in enumerate(sorted(places, key=lambda k: k.encode("utf-8"))):
+            row = places[key]
+            table[i] = (key.encode("utf-8"), row["name"].encode("utf-8"), row["state"].encode("utf-8"),
+                        row["country"].encode("utf-8"), float(row["lat"]), float(row["lon"]))
+
+        self._use(table)  # lookups use the table in memory until it is written
+        if not len(table):
+            return
+        try:
+            os.makedirs(os.path.dirname(self.table_file) or ".", exist_ok=True)
+            table.tofile(self.table_file + ".tmp")
+            os.replace(self.table_file + ".tmp", self.table_file)
+            self._use(np.memmap(self.table_file, dtype=RECORD, mode="r"))
+        except OSError as e:
+            print("[QUART SERVER] Could not write " + self.table_file + ", keeping the places in memory: " + e.__str__())
+
+    def _use(self, table):
+        self._index = (table, table["key"].view(np.ndarray))
+
+    def _find(self, key: bytes):
+        table, keys = self._index
+        i = int(np.searchsorted(keys, key))
+        if i == len(keys) or keys[i] != key:
+            return None
+        return table[i]
+
+    def lookup(self, location: str):
+        """
+        The places known for location ("city, country"), or None when it is not in the gazetteer
+        """
+        record = self._find(location_key(location).encode("utf-8"))
+        if record is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return [{"name": _text(record["name"]),
+                 "lat": float(record["lat"]),
+                 "lon": float(record["lon"]),
+                 "country": _text(record["country"]),
+                 "state": _text(record["state"])}]
+
+    def learn(self, location: str, places):
+        """
+        Store the result of a remote lookup of location, so the next lookup is local. Blocks on file I/O.
+        """
+        if not isinstance(places, list) or not places or "lat" not in places[0] or "lon" not in places[0]:
+            return False  # nothing found, or an error response
+        key = location_key(location).encode("utf-8")
+        if len(key) > KEY_SIZE:
+            return False
+        place = places[0]
+        with self._lock:
+            if self._find(key) is not None:
+                return False
+            try:
+                os.makedirs(os.path.dirname(self.learned_file) or ".", exist_ok=True)
+                with open(self.learned_file, "a", newline="", encoding="utf-8") as f:
+                    csv.writer(f, delimiter="\t").writerow([location, place.get("name", ""), place.get("state", ""),
+                                                            place.get("country", ""), place["lat"], place["lon"]])
+            except OSError as e:
+                print("[QUART SERVER] Could not write " + self.learned_file + ": " + e.__str__())
+                return False
+            self._compile()
+            self.learned += 1
+        return True
+
+    def stats(self):
+        return {"places": len(self._index[0]),
+                "hits": self.hits,
+                "misses": self.misses,
+                "learned": self.learned}
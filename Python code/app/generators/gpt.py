@@ -1,6 +1,9 @@
+import asyncio
 import datetime
 import glob
 import json
+import time
+from collections import deque
 
 import pandas as pd
 
@@ -13,6 +16,17 @@ responses_df = pd.concat([pd.read_csv(filename, sep="\t", index_col=None) for fi
                          ignore_index=True)
 responses_df["emotes"] = responses_df["emotes"].fillna("[]").apply(json.loads)
 
+STREAM_FIRST_SENTENCE = True  # send the first sentence of a response to the tablet while the rest is generated
+
+STARTER_PROMPT = "Start het gesprek met alleen de volgende 'message' (gebruik de goede begroeting): 'Goedemorgen/middag/avond, hoe voel je je vandaag?'."
+STARTER_TYPES = {"rich-empathy-starter": "rich-empathy-conversation",
+                 "basic-empathy-starter": "basic-empathy-conversation"}
+STARTER_POOL_SIZE = 2  # pre-generated starters kept per type of conversation
+STARTER_POOL_MAX_AGE_MINS = 60  # starters older than this are not used anymore
+
+starter_pool = {}  # {(message_id, daypart) : deque of (monotonic time of generating, gpt data)}
+starter_refills = set()  # keys of the pools that are being refilled
+
 f = open("config/instructions/rich_assistant.txt")
 rich_instructions = f.read()
 f.close()
@@ -33,29 +47,39 @@ f = open("config/instructions/basic_format.txt")
 basic_format = f.read()
 f.close()
 
+"""
+The static part of the system prompts is built once, so the start of every prompt is byte for byte the same and can be
+served from OpenAI's prompt cache. The time stamp changes every turn and is sent as the last message instead.
+"""
+RICH_SYSTEM_MESSAGE = {"role": "system", "content": rich_instructions + "\n" + rich_task + "\n" + rich_formats}
+BASIC_SYSTEM_MESSAGE = {"role": "system", "content": basic_instructions + basic_format}
+RICH_END_MESSAGE = {"role": "system",
+                    "content": "Bij deze is het gesprek voorbij. Antwoord nog op de vorige reactie van de gebruiker. "
+                               "Sluit het gesprek af zonder verdere vragen te stellen. "
+                               "Vermijd boodschappen die suggereren dat je "
+                               "beschikbaar of te vinden bent voor toekomstige gesprekken of vragen. "
+                               "Benadruk dat de interactie eindigt en er geen "
+                               "verdere contactmogelijkheden zijn. "}
 
-async def from_gpt_rich(controller, chat_history: dict):
-    options, colors, emotes = {}, {}, {}
 
-    try:
-        ct = datetime.datetime.now()
-        messages = [{"role": "system", "content": rich_instructions +
-                                                  "\n" + rich_task +
-                                                  "\n" + rich_formats +
-                                                  "\n" + f"Time is {ct}"}]
+def build_messages(system_message: dict, chat_history: list, *trailing_messages):
+    messages = [system_message]
+    messages.extend(chat_history[-10:])  # laatste 10 berichten, gaat dit goed
+    messages.extend(trailing_messages)
+    messages.append({"role": "system", "content": f"Time is {datetime.datetime.now()}"})
+    return messages
 
-        messages = messages + chat_history[-10:]  # laatste 10 berichten, gaat dit goed
 
+async def from_gpt_rich(controller, chat_history: dict, on_first_sentence=None):
+    options, colors, emotes, data, end_indicator = {}, {}, {}, {}, "no"
+
+    try:
         if len(chat_history) == 7:
-            messages.append({"role": "system",
-                             "content": "Bij deze is het gesprek voorbij. Antwoord nog op de vorige reactie van de gebruiker. "
-                                        "Sluit het gesprek af zonder verdere vragen te stellen. "
-                                        "Vermijd boodschappen die suggereren dat je "
-                                        "beschikbaar of te vinden bent voor toekomstige gesprekken of vragen. "
-                                        "Benadruk dat de interactie eindigt en er geen "
-                                        "verdere contactmogelijkheden zijn. "})
+            messages = build_messages(RICH_SYSTEM_MESSAGE, chat_history, RICH_END_MESSAGE)
+        else:
+            messages = build_messages(RICH_SYSTEM_MESSAGE, chat_history)
 
-        data = await controller.complete_with_gpt(messages)
+        data = await controller.complete_with_gpt(messages, on_first_sentence=on_first_sentence)
 
         message = data.get("message", "Er gaat iets fout, probeer opnieuw.").strip()
         default_emotes = {"head": "default",
@@ -75,18 +99,13 @@ async def from_gpt_rich(controller, chat_history: dict):
     return message, options, emotes, colors, data, end_indicator
 
 
-async def from_gpt_basic(controller, chat_history: dict):
-    options, colors, emotes = {}, {}, {}
+async def from_gpt_basic(controller, chat_history: dict, on_first_sentence=None):
+    options, colors, emotes, data = {}, {}, {}, {}
 
     try:
-        ct = datetime.datetime.now()
-        messages = [{"role": "system", "content": basic_instructions +
-                                                  basic_format +
-                                                  "\n" + f"Time is {ct}"}]
-
-        messages = messages + chat_history[-10:]  # laatste 10 berichten, gaat dit goed
+        messages = build_messages(BASIC_SYSTEM_MESSAGE, chat_history)
 
-        data = await controller.complete_with_gpt(messages)
+        data = await controller.complete_with_gpt(messages, on_first_sentence=on_first_sentence)
 
         message = data.get("message", "Er gaat iets fout, probeer opnieuw.").strip()
         default_emotes = {"head": "default",
@@ -106,6 +125,69 @@ async def from_gpt_basic(controller, chat_history: dict):
     return message, options, emotes, colors, data
 
 
+def get_daypart(now: datetime.datetime = None):
+    hour = (now if now else datetime.datetime.now()).hour
+    if 6 <= hour < 12:
+        return "morning"
+    if 12 <= hour < 18:
+        return "afternoon"
+    return "evening"
+
+
+def take_starter(message_id: str):
+    """
+    Take a pre-generated starter for the current daypart from the pool, None if there is none
+    """
+    pool = starter_pool.get((message_id, get_daypart()))
+    while pool:
+        generated_at, data = pool.popleft()
+        if time.monotonic() - generated_at <= STARTER_POOL_MAX_AGE_MINS * 60:
+            return data
+    return None
+
+
+def from_starter(data: dict):
+    message = data["message"].strip()
+    emotes = data.get("emotes", {"head": "default",
+                                 "lefthand": "default",
+                                 "righthand": "default"})
+    return message, {}, emotes, {}, data
+
+
+async def _generate_starter(controller, message_id: str):
+    chat_history = [{"role": "user", "content": STARTER_PROMPT}]  # the history right after pressing a start button
+    if message_id == "basic-empathy-conversation":
+        message, options, emotes, colors, data = await from_gpt_basic(controller, chat_history)
+    else:
+        message, options, emotes, colors, data, end_indicator = await from_gpt_rich(controller, chat_history)
+    return data
+
+
+async def refill_starter_pool(controller, message_id: str):
+    """
+    Generate starters of message_id for the current daypart until its pool is full. Only called when a starter of
+    message_id was asked for, taken or not, so an idle server makes no GPT calls for the pool.
+    """
+    daypart = get_daypart()
+    key = (message_id, daypart)
+    if key in starter_refills:  # already being refilled
+        return
+    starter_refills.add(key)
+    try:
+        for other in [other for other in starter_pool if other[1] != daypart]:
+            del starter_pool[other]
+        pool = starter_pool.setdefault(key, deque())
+        while pool and time.monotonic() - pool[0][0] > STARTER_POOL_MAX_AGE_MINS * 60:
+            pool.popleft()
+        results = await asyncio.gather(*[_generate_starter(controller, message_id)
+                                         for _ in range(STARTER_POOL_SIZE - len(pool))], return_exceptions=True)
+        for data in results:
+            if isinstance(data, dict) and "message" in data:
+                pool.append((time.monotonic(), data))
+    finally:
+        starter_refills.discard(key)
+
+
 async def generate_response(message_in, controller, lang="nl"):
     """
     Unpack the data
@@ -124,14 +206,33 @@ async def generate_response(message_in, controller, lang="nl"):
     """
     Generate response
     """
+    spoken = []
+
+    async def send_first_sentence(sentence: str):
+        sentence = await variable.fill(sentence, tablet_id, controller, lang=lang)
+        sentence = format_funcs.format_all(message_in=sentence, lang=lang)
+        spoken.append(sentence)
+        await controller.send_partial_response(message_in["client"], sentence)
+
+    on_first_sentence = send_first_sentence if STREAM_FIRST_SENTENCE else None
+
     key = message_in["data"]["message_id"]
     end_indicator = "no"
-    if key == "basic-empathy-conversation":
+    starter = None
+    if message_type in STARTER_TYPES:
+        starter = take_starter(key)
+        controller.add_background_task(refill_starter_pool, controller, key)  # replace it, or have one next time
+    if starter:
+        message_content, response_options, emotes, colors, gpt_data = from_starter(starter)
+        end_indicator = starter.get("end", "no")
+    elif key == "basic-empathy-conversation":
         message_content, response_options, emotes, colors, gpt_data = await from_gpt_basic(controller,
-                                                                                            chat_history)
+                                                                                            chat_history,
+                                                                                            on_first_sentence)
     else:
         message_content, response_options, emotes, colors, gpt_data, end_indicator = await from_gpt_rich(controller,
-                                                                                                           chat_history)
+                                                                                                           chat_history,
+                                                                                                           on_first_sentence)
 
     """
     You could choose to add 'template' variables and fill them in after, you could use this function for that
@@ -145,6 +246,8 @@ async def generate_response(message_in, controller, lang="nl"):
     message_id = "basic-empathy-conversation" if key == "basic-empathy-conversation" else "rich-empathy-conversation"
     message_data = {"message": message_content, "message_id": message_id, "message_lang": lang,
                     "buttons": response_options}
+    if spoken and message_content.startswith(spoken[0]):  # only speak what was not spoken yet
+        message_data["messageTts"] = message_content[len(spoken[0]):].strip() or "   "
 
     if message_id == "basic-empathy-conversation" and len(chat_history) >= 3:
         message_data["message_id"] = "conversation-end"
@@ -152,7 +255,7 @@ async def generate_response(message_in, controller, lang="nl"):
         message_data["message_id"] = "conversation-end"
 
     extra = emote.get_emotes_from_keys(emotes)
-    message_data["extra"] = json.dumps(extra)
+    message_data["extra"] = extra  # encoded together with the rest of the message when it is sent
     outgoing_message = {"type": "external_interaction_message",
                         "data": message_data,
                         "client": message_in["client"]}
@@ -174,7 +277,7 @@ it will immediately call your generate_response(get_conversation_starter()) func
 
 def get_rich_empathy_starter(tablet_id):
     response_button = {"value": "rich-empathy-starter",  # this is what you will receive to respond to
-                       "label": "Start het gesprek met alleen de volgende 'message' (gebruik de goede begroeting): 'Goedemorgen/middag/avond, hoe voel je je vandaag?'."}
+                       "label": STARTER_PROMPT}
 
     message_data = {"message": "this will not be used",  # this is a placeholder
                     "message_id": "rich-empathy-conversation",  # this denotes that we want to receive the response
@@ -190,7 +293,7 @@ def get_rich_empathy_starter(tablet_id):
 
 def get_basic_empathy_starter(tablet_id):
     response_button = {"value": "basic-empathy-starter",  # this is the prompt use to select a response
-                       "label": "Start het gesprek met alleen de volgende 'message' (gebruik de goede begroeting): 'Goedemorgen/middag/avond, hoe voel je je vandaag?'."}  # this is a placeholder
+                       "label": STARTER_PROMPT}  # this is a placeholder
 
     message_data = {"message": "this will not be used",  # this is a placeholder
                     "message_id": "basic-empathy-conversation",  # this denotes that we want to receive the response
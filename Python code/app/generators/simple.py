@@ -2,6 +2,7 @@ import pandas as pd
 import glob
 import numpy as np
 import json
+import random
 from . import format_funcs
 from . import variable
 from . import emote
@@ -15,6 +16,15 @@ responses_df["styles"] = responses_df["styles"].fillna("{}").apply(json.loads)
 responses_df["lang"] = responses_df["lang"].str.strip()
 responses_df["message_content"] = responses_df["message_content"].str.strip()
 
+response_index = {}  # {(message_type, lang) : ((message, emotes, styles), ...)}, so from_key never touches pandas
+for message_type, lang, message, emotes, styles in zip(responses_df["message_type"], responses_df["lang"],
+                                                      responses_df["message_content"], responses_df["emotes"],
+                                                      responses_df["styles"]):
+    response_index.setdefault((message_type, lang), []).append((message, emotes, styles))
+    if isinstance(message, str):
+        variable.precompile(message)
+response_index = {k: tuple(v) for k, v in response_index.items()}
+
 file_list = glob.glob("config/flows/**/*.tsv", recursive=True)
 dialogue_df = pd.concat([pd.read_csv(filename, sep="\t", index_col=None) for filename in file_list], axis=0,
                         ignore_index=True)
@@ -37,15 +47,10 @@ async def from_key(args: dict, lang: str):
         return None, None, None
     key = args["key"]
 
-    available_responses = responses_df[responses_df["message_type"] == key]
-    responses_lang = available_responses[available_responses["lang"] == lang]
-
-    if len(responses_lang) == 0:
+    responses_lang = response_index.get((key, lang))
+    if not responses_lang:
         return None, None, None
-    generated_response = responses_lang.sample(1)
-    message = generated_response["message_content"].to_numpy()[0]
-    emotes = generated_response["emotes"].to_numpy()[0]
-    styles = generated_response["styles"].to_numpy()[0]
+    message, emotes, styles = random.choice(responses_lang)
     return message, emotes, styles
 
 
@@ -92,7 +97,7 @@ async def generate_response(message_in, controller, lang="nl"):
                         "message_lang": lang}
 
     extra = emote.get_emotes_from_keys(emotes)
-    message_data["extra"] = json.dumps(extra)
+    message_data["extra"] = extra  # encoded together with the rest of the message when it is sent
     outgoing_message = {"type": "external_interaction_message",
                         "data": message_data,
                         "client": message_in["client"]}
@@ -1,9 +1,11 @@
+import asyncio
 import locale
 from enum import Enum
 from datetime import datetime, timedelta
 import pandas as pd
 import glob
 import re
+import random
 import inflect
 from dateutil import tz as dt_tz
 
@@ -11,6 +13,11 @@ file_list = glob.glob("config/variables/**/*.tsv", recursive=True)
 variables_df = pd.concat([pd.read_csv(filename, sep="\t", index_col=None) for filename in file_list], axis=0,
                          ignore_index=True)
 
+translation_index = {}  # {(varname, lang) : (value, ...)}, so get_translation never touches pandas
+for varname, value, lang in zip(variables_df["varname"], variables_df["value"], variables_df["lang"]):
+    translation_index.setdefault((varname, lang), []).append(value)
+translation_index = {k: tuple(v) for k, v in translation_index.items()}
+
 inf_eng = inflect.engine()
 
 MISSING_VAL = "??MISSING??"
@@ -435,11 +442,10 @@ class Defaults(str, Enum):
 
 
 def get_translation(key: str, lang: str):
-    available_variables = variables_df[variables_df['varname'] == key]
-    variables_lang = available_variables[available_variables['lang'] == lang]
-    if len(variables_lang) == 0:
+    variables_lang = translation_index.get((key, lang))
+    if not variables_lang:
         return key  # return the key if no translation is known
-    return variables_lang.sample(1)['value'].to_numpy()[0]
+    return random.choice(variables_lang)
 
 
 utc_zone = dt_tz.gettz('UTC')
@@ -846,23 +852,83 @@ async def get_client(tablet_id: str, controller, lang: str):
     return await controller.get_client_data(tablet_id)
 
 
+VARIABLE_PATTERN = re.compile(r'\["([^\]]+)"\]')  # variables are inserted as ["VARIABLE-NAME"]
+
+
+class Template(object):
+    """
+    Message split once into literal text and variable inserts, rendering is a single join
+    """
+
+    def __init__(self, message: str):
+        parts = VARIABLE_PATTERN.split(message)  # literal, variable, literal, ..., literal
+        self.literals = parts[0::2]
+        self.variables = parts[1::2]
+        self.capitalized = [key in capitalize for key in self.variables]
+        self.to_fill = list(dict.fromkeys(self.variables))  # unique variables in order of appearance
+
+    def render(self, env: dict):
+        out = [self.literals[0]]
+        for key, capitalized, literal in zip(self.variables, self.capitalized, self.literals[1:]):
+            value = str(env[key])
+            if capitalized:  # capitalize specified variables
+                value = " ".join(x.capitalize() for x in value.split(" "))
+            out.append(value)
+            out.append(literal)
+        return "".join(out)
+
+
+templates = {}  # {message : Template} for messages known at load time, e.g. the configured responses
+
+
+def precompile(message: str):
+    if message not in templates:
+        templates[message] = Template(message)
+    return templates[message]
+
+
 async def fill(message_in: str, tablet_id: str, controller, lang: str):
-    to_fill = set(re.findall('\["[^\]]+"\]', message_in))
-    to_fill = [x[2:-2] for x in to_fill]
-    if not to_fill:
+    template = templates.get(message_in)
+    if template is None:
+        template = Template(message_in)  # e.g. gpt output, not worth keeping around
+    if not template.to_fill:
         return message_in
 
-    env = await get_vars(to_fill, tablet_id, controller, lang)
+    env = await get_vars(template.to_fill, tablet_id, controller, lang)
+    return template.render(env)
+
+
+class DataSource(str, Enum):
+    """
+    The data a variable family is filled from, every variable starting with the value belongs to that family
+    """
+    CLIENT = "CLIENT"
+    DATETIME = "DATETIME"
+    CALENDAR = "CALENDAR"
+    REPORT = "REPORT"
+    WEATHER_NOW = "WEATHER-NOW"
+    WEATHER_FORECAST = "WEATHER-FORECAST"
+    NEWS = "NEWS"
+
+    def __str__(self):
+        return str(self.value).lower()
 
-    for key in capitalize:  # capitalize specified variables
-        if key in env:
-            env[key] = " ".join(x.capitalize() for x in env[key].split(" "))
 
-    message_out = str(message_in)
-    for key in env.keys():  # replace variable inserts
-        message_out = message_out.replace('["' + key + '"]', str(env[key]))
+resolvers = {DataSource.CLIENT: get_client,
+             DataSource.DATETIME: get_datetime,
+             DataSource.CALENDAR: get_calendar,
+             DataSource.REPORT: get_reports,
+             DataSource.WEATHER_NOW: get_weather_now,
+             DataSource.WEATHER_FORECAST: get_weather_forecast,
+             DataSource.NEWS: get_news,
+             }
 
-    return message_out
+
+def get_source(key: str):
+    for source in DataSource:
+        if key.startswith(source.value):
+            return source
+    return None  # e.g. ASSISTANT-NAME, only needs its default
 
 
 async def get_vars(to_get: list, tablet_id: str, controller, lang: str):
@@ -873,43 +939,13 @@ async def get_vars(to_get: list, tablet_id: str, controller, lang: str):
         else:
             env[key] = MISSING_VAL
 
-    joined_get = " ".join(to_get)
-    if 'CLIENT' in joined_get:
-        env.update(await get_client(tablet_id, controller, lang=lang))
-
-    if 'DATETIME' in joined_get:
-        env.update(await get_datetime(tablet_id, controller, lang=lang))
-
-    if 'CALENDAR' in joined_get:
-        calendar_vars = await get_calendar(tablet_id, controller, lang=lang)
-        for t in to_get:
-            if t in calendar_vars.keys():
-                env[t] = calendar_vars[t]
-
-    if 'REPORT' in joined_get:
-        report_vars = await get_reports(tablet_id, controller, lang=lang)
-        for t in to_get:
-            if t in report_vars.keys():
-                env[t] = report_vars[t]
-
-    if 'WEATHER-NOW' in joined_get:
-        print('weather')
-        weather_now_vars = await get_weather_now(tablet_id, controller, lang=lang)
-        print(weather_now_vars)
-        for t in to_get:
-            if t in weather_now_vars.keys():
-                env[t] = weather_now_vars[t]
-
-    if 'WEATHER-FORECAST' in joined_get:
-        weather_forecast_vars = await get_weather_forecast(tablet_id, controller, lang=lang)
-        for t in to_get:
-            if t in weather_forecast_vars.keys():
-                env[t] = weather_forecast_vars[t]
+    # fetch exactly the sources the variables need, all at the same time
+    sources = list({get_source(key) for key in to_get} - {None})
+    results = await asyncio.gather(*[resolvers[source](tablet_id, controller, lang=lang) for source in sources])
 
-    if 'NEWS' in joined_get:
-        news_vars = await get_news(tablet_id, controller, lang=lang)
+    for source_vars in results:
         for t in to_get:
-            if t in news_vars.keys():
-                env[t] = news_vars[t]
+            if t in source_vars.keys():
+                env[t] = source_vars[t]
 
-    return env
\ No newline at end of file
+    return env
@@ -0,0 +1,251 @@
+import csv
+import gzip
+import os
+import queue
+import shutil
+import threading
+import time
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+COLUMNS = ["channel", "user_id", "tablet_id", "user_message", "assistant_output", "timestamp", "processing_time"]
+CATEGORICAL_COLUMNS = ["channel", "user_id", "tablet_id"]
+TEXT_COLUMNS = ["user_message", "assistant_output"]
+
+
+class HistoryStore(object):
+    """
+    Append-only message history kept in preallocated columns.
+    Channel, user and tablet ids are dictionary encoded, a DataFrame is only built when asked for.
+    With max_rows set the store becomes a ring buffer that only keeps the most recent rows in memory.
+    """
+
+    def __init__(self, capacity=1024, max_rows=None):
+        self._size = 0
+        self._start = 0  # position of the oldest row once the ring buffer wraps around
+        self._max_rows = max_rows
+        self._capacity = min(capacity, max_rows) if max_rows else capacity
+        self._codes = {col: np.empty(self._capacity, dtype=np.int32) for col in CATEGORICAL_COLUMNS}
+        self._categories = {col: [] for col in CATEGORICAL_COLUMNS}  # {column : [value]}
+        self._category_codes = {col: {} for col in CATEGORICAL_COLUMNS}  # {column : {value : code}}
+        self._text = {col: np.empty(self._capacity, dtype=object) for col in TEXT_COLUMNS}
+        self._timestamp = np.empty(self._capacity, dtype="datetime64[us]")
+        self._processing_time = np.empty(self._capacity, dtype="timedelta64[us]")
+
+    def __len__(self):
+        return self._size
+
+    def _grow(self):
+        self._capacity *= 2  # doubling keeps appends amortized O(1)
+        if self._max_rows:
+            self._capacity = min(self._capacity, self._max_rows)
+        for col in CATEGORICAL_COLUMNS:
+            self._codes[col] = np.resize(self._codes[col], self._capacity)
+        for col in TEXT_COLUMNS:
+            self._text[col] = np.resize(self._text[col], self._capacity)
+        self._timestamp = np.resize(self._timestamp, self._capacity)
+        self._processing_time = np.resize(self._processing_time, self._capacity)
+
+    def _encode(self, col: str, value):
+        codes = self._category_codes[col]
+        if value not in codes:
+            codes[value] = len(self._categories[col])
+            self._categories[col].append(value)
+        return codes[value]
+
+    def append(self, channel, user_id, tablet_id, user_message, assistant_output, timestamp, processing_time):
+        if self._size == self._capacity and self._capacity != self._max_rows:
+            self._grow()
+        if self._size == self._capacity:  # full ring buffer, overwrite the oldest row
+            i = self._start
+            self._start = (self._start + 1) % self._capacity
+        else:
+            i = self._size
+            self._size += 1
+        self._codes["channel"][i] = self._encode("channel", str(channel))
+        self._codes["user_id"][i] = self._encode("user_id", user_id)
+        self._codes["tablet_id"][i] = self._encode("tablet_id", tablet_id)
+        self._text["user_message"][i] = user_message
+        self._text["assistant_output"][i] = assistant_output
+        self._timestamp[i] = timestamp
+        self._processing_time[i] = processing_time
+
+    def _rows(self):
+        if self._start == 0:
+            return np.arange(self._size)
+        return (self._start + np.arange(self._size)) % self._capacity  # oldest row first
+
+    def _frame(self, rows):
+        data = {}
+        for col in COLUMNS:
+            if col in CATEGORICAL_COLUMNS:
+                data[col] = pd.Categorical.from_codes(self._codes[col][rows],
+                                                      categories=pd.Index(self._categories[col], dtype=object))
+            elif col in TEXT_COLUMNS:
+                data[col] = self._text[col][rows]
+            elif col == "timestamp":
+                data[col] = self._timestamp[rows]
+            else:
+                data[col] = self._processing_time[rows]
+        return pd.DataFrame(data, columns=COLUMNS)
+
+    def to_frame(self):
+        """
+        Materialize the history as a DataFrame
+        """
+        return self._frame(self._rows())
+
+    def _bisect(self, timestamp: datetime, right=False):
+        # rows are appended in time order, so the (wrapped around) timestamp column is sorted
+        value = np.datetime64(timestamp, "us")
+        lo, hi = 0, self._size
+        while lo < hi:
+            mid = (lo + hi) // 2
+            t = self._timestamp[(self._start + mid) % self._capacity]
+            if t < value or (right and t == value):
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def query(self, limit=50, offset=0, tablet_id=None, channel=None, since: datetime = None,
+              until: datetime = None, chunk=1024):
+        """
+        Return a page of the history, newest rows first, and whether there are more (older) rows.
+        Only the rows in the requested time range are looked at, and those only until the page is full.
+        """
+        filters = []
+        for col, value in [("tablet_id", tablet_id), ("channel", channel)]:
+            if value is None:
+                continue
+            if value not in self._category_codes[col]:
+                return self._frame(np.arange(0)), False
+            filters.append((col, self._category_codes[col][value]))
+
+        lo = self._bisect(since) if since else 0
+        hi = self._bisect(until, right=True) if until else self._size
+
+        wanted = offset + limit + 1  # one extra row to know whether there is a next page
+        found = []
+        n_found = 0
+        while hi > lo and n_found < wanted:
+            logical = np.arange(hi - 1, max(hi - chunk, lo) - 1, -1)  # newest first
+            rows = (self._start + logical) % self._capacity
+            for col, code in filters:
+                rows = rows[self._codes[col][rows] == code]
+            found.append(rows)
+            n_found += len(rows)
+            hi -= chunk
+
+        rows = np.concatenate(found) if found else np.arange(0)
+        return self._frame(rows[offset:offset + limit]), len(rows) > offset + limit
+
+
+class HistorySink(object):
+    """
+    Write-behind log of the message history.
+    Records are handed to a writer thread that appends them in batches to tab separated segment files in log_dir.
+    A segment is closed (and optionally gzipped) once it exceeds max_bytes or is older than max_age_mins.
+    At most max_queue records wait for the writer, when it falls further behind records are dropped and counted.
+    """
+
+    def __init__(self, log_dir="logs", max_bytes=16 * 1024 * 1024, max_age_mins=24 * 60, compress=False,
+                 batch_size=256, max_queue=16384, channel="QUART SERVER"):
+        self.log_dir = log_dir
+        self.max_bytes = max_bytes
+        self.max_age_mins = max_age_mins
+        self.compress = compress
+        self.batch_size = batch_size
+        self.channel = channel  # prefix of the log lines
+
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._dropping = False
+        self.written = 0
+        self.dropped = 0
+        self._file = None
+        self._writer = None
+        self._path = None
+        self._opened_at = 0
+        self._thread = threading.Thread(target=self._run, name="history-sink", daemon=True)
+        self._thread.start()
+
+    def write(self, channel, user_id, tablet_id, user_message, assistant_output, timestamp: datetime,
+              processing_time):
+        try:
+            self._queue.put_nowait((str(channel), user_id, tablet_id, user_message, str(assistant_output),
+                                    timestamp.isoformat(), processing_time))
+        except queue.Full:
+            self.dropped += 1
+            if not self._dropping:  # once until the writer has caught up, not for every record
+                self._dropping = True
+                print("[" + self.channel + "] Message history writer is behind, dropping records")
+
+    def close(self, timeout=10):
+        """
+        Flush the last batch and close the current segment
+        """
+        if not self._thread.is_alive():
+            return
+        self._queue.put(None)
+        self._thread.join(timeout)
+
+    def _open_segment(self):
+        os.makedirs(self.log_dir, exist_ok=True)
+        name = datetime.utcnow().strftime("%d-%m-%Y %H-%M-%S")
+        path, i = os.path.join(self.log_dir, name + ".log"), 1
+        while os.path.exists(path) or os.path.exists(path + ".gz"):
+            path, i = os.path.join(self.log_dir, name + " (" + str(i) + ").log"), i + 1
+        self._path = path
+        self._file = open(path, "w", newline="", encoding="utf-8")
+        self._writer = csv.writer(self._file, delimiter="\t")
+        self._writer.writerow(COLUMNS)
+        self._opened_at = time.monotonic()
+
+    def _close_segment(self):
+        if not self._file:
+            return
+        self._file.close()
+        self._file = None
+        if self.compress:
+            with open(self._path, "rb") as f_in, gzip.open(self._path + ".gz", "wb") as f_out:
+                shutil.copyfileobj(f_in, f_out)
+            os.remove(self._path)
+
+    def _should_rotate(self):
+        return self._file.tell() > self.max_bytes or time.monotonic() - self._opened_at > self.max_age_mins * 60
+
+    def _run(self):
+        running = True
+        while running:
+            batch = [self._queue.get()]  # block until there is something to write
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            if None in batch:
+                running = False
+                batch = [record for record in batch if record is not None]
+
+            try:
+                if batch:
+                    if not self._file:
+                        self._open_segment()
+                    self._writer.writerows(batch)
+                    self._file.flush()
+                    self.written += len(batch)
+                    if self._queue.empty():
+                        self._dropping = False
+                    if self._should_rotate():
+                        self._close_segment()
+            except Exception as e:
+                print("[" + self.channel + "] Could not write message history: " + e.__str__())
+        self._close_segment()
+
+    def stats(self):
+        return {"written": self.written,
+                "dropped": self.dropped,
+                "queued": self._queue.qsize(),
+                "capacity": self._queue.maxsize}
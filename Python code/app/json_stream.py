@@ -0,0 +1,107 @@
+import re
+
+ESCAPES = {'"': '"', "\\": "\\", "/": "/", "b": "\b", "f": "\f", "n": "\n", "r": "\r", "t": "\t"}
+SENTENCE_END = re.compile(r"[.!?…]+[\"')\]]*\s")
+# short words that end with a period without ending the sentence, lower case and without their final period
+ABBREVIATIONS = {"dr", "drs", "ir", "ing", "mr", "mrs", "ms", "mw", "mevr", "dhr", "prof", "st", "jr", "sr",
+                 "bijv", "bv", "b.v", "o.a", "d.w.z", "m.b.t", "t.o.v", "a.s", "i.p.v", "z.s.m", "enz", "etc", "ca",
+                 "nr", "jl", "vs", "e.g", "i.e"}
+LAST_WORD = re.compile(r"[\w.]+$")
+
+
+class JsonFieldExtractor(object):
+    """
+    Pulls the value of a top level string field out of a JSON object that is still coming in.
+    feed() takes the next piece of the JSON text and returns the part of the value that it completed, unescaped.
+    Only the text of the object is looked at, it does not have to be valid (yet).
+    """
+
+    def __init__(self, field="message"):
+        self.field = field
+        self.value = ""
+        self.done = False  # the value of the field was read completely
+
+        self._depth = 0
+        self._in_string = False
+        self._escape = None  # characters of the escape sequence being read, None outside an escape sequence
+        self._string = []  # characters of the string being read (only kept for keys)
+        self._expect_key = False
+        self._key = None  # the last key read at the top level
+        self._await_value = False  # read the ':' after the field, the value comes next
+        self._in_value = False  # reading the value of the field
+        self._surrogate = ""  # the first half of a surrogate pair
+
+    def feed(self, chunk: str):
+        out = []
+        for c in chunk:
+            if self._await_value and not c.isspace():
+                self._await_value = False
+                self._in_value = c == '"'  # anything but a string is not extracted
+            if self._in_string:
+                self._read_string(c, out)
+            elif c == '"':
+                self._in_string = True
+                self._string = []
+            elif c in "{[":
+                self._depth += 1
+                self._expect_key = c == "{" and self._depth == 1
+            elif c in "}]":
+                self._depth -= 1
+            elif c == "," and self._depth == 1:
+                self._expect_key = True
+                self._key = None
+            elif c == ":" and self._depth == 1 and self._key == self.field and not self.done:
+                self._await_value = True
+        new = "".join(out)
+        self.value += new
+        return new
+
+    def _read_string(self, c: str, out: list):
+        target = out if self._in_value else self._string
+        if self._escape is not None:
+            self._escape += c
+            if self._escape[0] != "u":
+                target.append(ESCAPES.get(c, c))
+                self._escape = None
+            elif len(self._escape) == 5:
+                self._read_unicode(chr(int(self._escape[1:], 16)), target)
+                self._escape = None
+        elif c == "\\":
+            self._escape = ""
+        elif c == '"':
+            self._end_string()
+        else:
+            target.append(c)
+
+    def _read_unicode(self, c: str, target: list):
+        if "\ud800" <= c <= "\udbff":
+            self._surrogate = c
+            return
+        if self._surrogate and "\udc00" <= c <= "\udfff":
+            c = (self._surrogate + c).encode("utf-16", "surrogatepass").decode("utf-16")
+        self._surrogate = ""
+        target.append(c)
+
+    def _end_string(self):
+        self._in_string = False
+        if self._in_value:
+            self._in_value = False
+            self.done = True
+        elif self._depth == 1 and self._expect_key:
+            self._key = "".join(self._string)
+            self._expect_key = False
+
+
+def first_sentence(text: str):
+    """
+    Return the first sentence of text once it is certainly complete (followed by whitespace), else None.
+    A period after a known abbreviation or an initial does not end the sentence.
+    """
+    for match in SENTENCE_END.finditer(text):
+        if match.group().rstrip() == ".":
+            word = LAST_WORD.search(text, 0, match.start())
+            word = word.group().lower() if word else ""
+            if word in ABBREVIATIONS or (len(word) == 1 and word.isalpha()):  # "Dr. Jansen", "bijv. thee", "J. Jansen"
+                continue
+        return text[:match.end()].strip()
+    return None
@@ -0,0 +1,84 @@
+import asyncio
+from collections import deque
+
+
+class Mailboxes(object):
+    """
+    Bounded queue that keeps a separate mailbox per key (tablet id).
+    The messages of one key are handed out one at a time and in order: the next message of a key is only handed out
+    after done(key) was called for the previous one. Keys with waiting messages take turns, so a key with a long
+    backlog cannot starve the others.
+    """
+
+    def __init__(self, maxsize=1024, max_per_key=64):
+        self.maxsize = maxsize  # messages waiting over all mailboxes
+        self.max_per_key = max_per_key  # messages waiting in a single mailbox
+
+        self._boxes = {}  # {key : deque of waiting messages}
+        self._ready = deque()  # keys that have a waiting message and nothing in progress, in turn order
+        self._busy = set()  # keys with a message in progress
+        self._size = 0
+        self._unfinished = 0
+        self._changed = asyncio.Condition()
+
+    def qsize(self):
+        return self._size
+
+    def keys(self):
+        return len(self._boxes)
+
+    def full(self, key=None):
+        """
+        Whether the queue is full, or with a key, whether the mailbox of that key is full
+        """
+        if key is None:
+            return self._size >= self.maxsize
+        return len(self._boxes.get(key, ())) >= self.max_per_key
+
+    async def put(self, key, item):
+        """
+        Add a message to the mailbox of key and return True, waits while the queue is full.
+        Never waits for a full mailbox, returns False right away instead: the caller decides what to drop.
+        """
+        async with self._changed:
+            await self._changed.wait_for(lambda: not self.full())
+            if self.full(key):
+                return False
+            box = self._boxes.setdefault(key, deque())
+            box.append(item)
+            self._size += 1
+            self._unfinished += 1
+            if len(box) == 1 and key not in self._busy:
+                self._ready.append(key)
+            self._changed.notify_all()
+            return True
+
+    async def get(self):
+        """
+        Take the next message of the next key in turn, returns (key, message)
+        """
+        async with self._changed:
+            await self._changed.wait_for(lambda: self._ready)
+            key = self._ready.popleft()
+            item = self._boxes[key].popleft()
+            self._size -= 1
+            self._busy.add(key)
+            self._changed.notify_all()
+            return key, item
+
+    async def done(self, key):
+        """
+        Mark the message in progress for key as handled, which makes the next message of key available
+        """
+        async with self._changed:
+            self._busy.discard(key)
+            self._unfinished -= 1
+            if self._boxes[key]:
+                self._ready.append(key)  # back of the line, after the keys that were already waiting
+            else:
+                del self._boxes[key]
+            self._changed.notify_all()
+
+    async def join(self):
+        async with self._changed:
+            await self._changed.wait_for(lambda: self._unfinished == 0)
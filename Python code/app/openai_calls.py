@@ -0,0 +1,180 @@
+import asyncio
+import random
+import time
+from enum import Enum
+
+import openai
+
+
+class CircuitState(str, Enum):
+    CLOSED = "closed"  # calls go through
+    OPEN = "open"  # calls fail fast
+    HALF_OPEN = "half-open"  # one trial call goes through to see if the provider has recovered
+
+    def __str__(self):
+        return self.value
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+def is_retryable(e: Exception):
+    if isinstance(e, (asyncio.TimeoutError, openai.APIConnectionError)):  # includes openai.APITimeoutError
+        return True
+    if isinstance(e, openai.APIStatusError):
+        return e.status_code in (408, 409, 429) or e.status_code >= 500
+    return False
+
+
+def _retry_after(e: Exception):
+    response = getattr(e, "response", None)
+    try:
+        return float(response.headers.get("retry-after"))
+    except Exception:
+        return 0
+
+
+class OpenAICallManager(object):
+    """
+    Runs the calls to OpenAI with a cap on the number of calls in flight, in total and per model.
+    Calls that fail with a retryable error (timeouts, connection errors, 429 and 5xx) are retried with jittered
+    exponential backoff within the deadline of the call. The deadline includes the wait for a place under the caps, a
+    call that is still waiting at its deadline is rejected with asyncio.TimeoutError. After failure_threshold calls in
+    a row failed, the circuit opens and calls fail fast with CircuitOpenError, after reset_after seconds a single trial
+    call is let through.
+    """
+
+    def __init__(self, max_concurrent=16, max_per_model: dict = None, default_per_model=8, retries=3, base_delay=0.5,
+                 max_delay=8, timeout=60, failure_threshold=5, reset_after=30):
+        self.max_concurrent = max_concurrent
+        self.max_per_model = max_per_model if max_per_model else {}  # {model : max calls in flight}
+        self.default_per_model = default_per_model
+        self.retries = retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.timeout = timeout  # default deadline of a call in seconds, including the retries
+        self.failure_threshold = failure_threshold
+        self.reset_after = reset_after
+
+        self._semaphore = asyncio.Semaphore(max_concurrent)
+        self._model_semaphores = {}  # {model : semaphore}
+        self._in_flight = {}  # {model : calls in flight}
+
+        self.state = CircuitState.CLOSED
+        self._opened_at = 0
+        self._trial_running = False
+        self.consecutive_failures = 0
+
+        self.calls = 0
+        self.succeeded = 0
+        self.failed = 0
+        self.retried = 0
+        self.timeouts = 0
+        self.rejected = 0
+
+    def _model_semaphore(self, model: str):
+        if model not in self._model_semaphores:
+            self._model_semaphores[model] = asyncio.Semaphore(self.max_per_model.get(model, self.default_per_model))
+        return self._model_semaphores[model]
+
+    async def _acquire(self, model: str, deadline: float):
+        """
+        Wait for a place under both limits until the deadline, returns the semaphores to release after the call
+        """
+        acquired = []
+        try:
+            for semaphore in (self._semaphore, self._model_semaphore(model)):
+                await asyncio.wait_for(semaphore.acquire(), deadline - time.monotonic())
+                acquired.append(semaphore)
+        except BaseException:
+            for semaphore in acquired:
+                semaphore.release()
+            raise
+        return acquired
+
+    def _admit(self):
+        """
+        Check the circuit before a call, returns whether this call is the trial call of a half open circuit
+        """
+        if self.state == CircuitState.OPEN and time.monotonic() - self._opened_at >= self.reset_after:
+            self.state = CircuitState.HALF_OPEN
+        if self.state == CircuitState.CLOSED:
+            return False
+        if self.state == CircuitState.HALF_OPEN and not self._trial_running:
+            self._trial_running = True
+            return True
+        self.rejected += 1
+        raise CircuitOpenError("OpenAI is unavailable, the circuit is " + str(self.state))
+
+    def _record(self, success: bool):
+        if success:
+            self.consecutive_failures = 0
+            self.state = CircuitState.CLOSED
+            return
+        self.consecutive_failures += 1
+        if self.state == CircuitState.HALF_OPEN or self.consecutive_failures >= self.failure_threshold:
+            self.state = CircuitState.OPEN
+            self._opened_at = time.monotonic()
+
+    async def call(self, model: str, request, deadline=None, may_retry=None):
+        """
+        Await request() under the limits of model, retried until the deadline (in seconds). With may_retry, a retry
+        only happens while may_retry() returns True, e.g. not after part of a streamed response was used.
+        """
+        trial = self._admit()
+        self.calls += 1
+        deadline = time.monotonic() + (deadline if deadline else self.timeout)
+        try:
+            attempt = 0
+            while True:
+                try:
+                    semaphores = await self._acquire(model, deadline)
+                except asyncio.TimeoutError:
+                    self.rejected += 1  # waited for a place until the deadline, OpenAI was not called
+                    raise
+                try:
+                    self._in_flight[model] = self._in_flight.get(model, 0) + 1
+                    try:
+                        result = await asyncio.wait_for(request(), deadline - time.monotonic())
+                    finally:
+                        self._in_flight[model] -= 1
+                        for semaphore in semaphores:
+                            semaphore.release()
+                    self.succeeded += 1
+                    self._record(True)
+                    return result
+                except Exception as e:
+                    if isinstance(e, asyncio.TimeoutError):
+                        self.timeouts += 1
+                    retryable = is_retryable(e)
+                    if not retryable or (may_retry is not None and not may_retry()):
+                        self.failed += 1
+                        # a bad request means OpenAI itself is doing fine, anything else (e.g. a response that cannot be
+                        # decoded) counts as a failure, so a trial call always closes or opens the circuit again
+                        self._record(not retryable and isinstance(e, openai.APIStatusError))
+                        raise
+                    delay = max(random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt)),
+                                _retry_after(e))
+                    if attempt >= self.retries or time.monotonic() + delay >= deadline or trial:
+                        self.failed += 1
+                        self._record(False)
+                        raise
+                    attempt += 1
+                    self.retried += 1
+                    await asyncio.sleep(delay)
+        finally:
+            if trial:
+                self._trial_running = False
+
+    def stats(self):
+        return {"state": str(self.state),
+                "consecutive_failures": self.consecutive_failures,
+                "in_flight": sum(self._in_flight.values()),
+                "in_flight_per_model": dict(self._in_flight),
+                "calls": self.calls,
+                "succeeded": self.succeeded,
+                "failed": self.failed,
+                "retried": self.retried,
+                "timeouts": self.timeouts,
+                "rejected": self.rejected}
@@ -0,0 +1,127 @@
+import time
+from array import array
+from collections import OrderedDict
+
+ROLES = ["system", "user", "assistant"]
+ROLE_CODES = {role: code for code, role in enumerate(ROLES)}
+
+
+class Conversation(object):
+    """
+    Append-only list of the turns of one conversation, roles are stored as small codes next to the texts.
+    """
+
+    def __init__(self):
+        self._roles = array("b")
+        self._contents = []
+        self.size = 0  # characters of content
+        self.last_used = time.monotonic()
+
+    def __len__(self):
+        return len(self._contents)
+
+    def append(self, role: str, content: str):
+        self._roles.append(ROLE_CODES[role])
+        self._contents.append(content)
+        self.size += len(content)
+        self.last_used = time.monotonic()
+
+    def turn(self, i: int):
+        return {"role": ROLES[self._roles[i]], "content": self._contents[i]}
+
+    def view(self):
+        return ConversationView(self, len(self))
+
+
+class ConversationView(object):
+    """
+    The turns of a conversation up to the moment the view was made. Indexing and slicing only build the turns that are
+    asked for, as new dicts, so the view can be taken every turn without copying the whole conversation.
+    """
+
+    def __init__(self, conversation: Conversation, length: int):
+        self._conversation = conversation
+        self._length = length
+
+    def __len__(self):
+        return self._length
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self._conversation.turn(i) for i in range(*index.indices(self._length))]
+        if index < 0:
+            index += self._length
+        if not 0 <= index < self._length:
+            raise IndexError("turn index out of range")
+        return self._conversation.turn(index)
+
+    def __iter__(self):
+        return (self._conversation.turn(i) for i in range(self._length))
+
+
+class SessionStore(object):
+    """
+    Conversations with GPT per tablet. Sessions that were not used for ttl_mins are dropped, and once all sessions
+    together hold more than max_chars characters the least recently used sessions are dropped.
+    """
+
+    def __init__(self, ttl_mins=30, max_chars=4 * 1024 * 1024):
+        self.ttl_mins = ttl_mins
+        self.max_chars = max_chars
+
+        self._sessions = OrderedDict()  # {tablet_id : conversation}, least recently used first
+        self._chars = 0
+
+        self.expired = 0
+        self.evicted = 0
+
+    def __contains__(self, tablet_id):
+        return tablet_id in self._sessions
+
+    def history(self, tablet_id: str):
+        self._expire()
+        if tablet_id not in self._sessions:
+            return Conversation().view()
+        self._sessions.move_to_end(tablet_id)
+        self._sessions[tablet_id].last_used = time.monotonic()
+        return self._sessions[tablet_id].view()
+
+    def append(self, tablet_id: str, role: str, content: str):
+        self._expire()
+        if tablet_id not in self._sessions:
+            self._sessions[tablet_id] = Conversation()
+        self._sessions.move_to_end(tablet_id)
+        self._sessions[tablet_id].append(role, content)
+        self._chars += len(content)
+        self._enforce_cap(keep=tablet_id)
+
+    def reset(self, tablet_id: str):
+        """
+        Start a new conversation for this tablet, the sessions of other tablets are left alone
+        """
+        if tablet_id in self._sessions:
+            self._chars -= self._sessions.pop(tablet_id).size
+
+    def _expire(self):
+        now = time.monotonic()
+        while self._sessions:
+            tablet_id, conversation = next(iter(self._sessions.items()))
+            if now - conversation.last_used <= self.ttl_mins * 60:
+                break
+            self.reset(tablet_id)
+            self.expired += 1
+
+    def _enforce_cap(self, keep: str):
+        for tablet_id in list(self._sessions):
+            if self._chars <= self.max_chars:
+                break
+            if tablet_id != keep:  # a single session over the cap stays, it is the one in use
+                self.reset(tablet_id)
+                self.evicted += 1
+
+    def stats(self):
+        return {"sessions": len(self._sessions),
+                "turns": sum(len(conversation) for conversation in self._sessions.values()),
+                "chars": self._chars,
+                "expired": self.expired,
+                "evicted": self.evicted}
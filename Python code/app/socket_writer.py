@@ -0,0 +1,96 @@
+import asyncio
+import itertools
+import time
+from enum import IntEnum
+
+
+class SendPriority(IntEnum):
+    HIGH = 0  # what the user is waiting for, e.g. the response in a conversation
+    NORMAL = 1
+    LOW = 2  # background traffic, e.g. reports
+
+    def __str__(self):
+        return self.name.lower()
+
+
+class SocketWriter(object):
+    """
+    Single writer for a websocket. Every send is put in a priority queue and written by the task running run(),
+    so frames never interleave and the most urgent frames go first. Frames that are ready together are written
+    back to back as one batch. send() returns once its frame was written, or raises the error of writing it.
+    While no task is running run(), e.g. before the websocket has connected, send() raises ConnectionError right away.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self._queue = asyncio.PriorityQueue()  # (priority, sequence number, frame, queued at, future)
+        self._sequence = itertools.count()  # keeps frames of the same priority in order
+        self._running = False
+
+        self.sent = 0
+        self.failed = 0
+        self.batches = 0
+        self.max_batch = 0
+        self.max_depth = 0
+        self._latency_total = 0
+        self._latency_last = 0
+        self._latency_max = 0
+
+    async def send(self, frame: str, priority=SendPriority.NORMAL):
+        if not self._running:
+            raise ConnectionError("Writer for " + self.name + " is not running")
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((priority, next(self._sequence), frame, time.monotonic(), future))
+        self.max_depth = max(self.max_depth, self._queue.qsize())
+        return await future
+
+    async def run(self, websocket):
+        """
+        Write queued frames to the websocket until cancelled
+        """
+        self._running = True
+        batch = []
+        try:
+            while True:
+                batch = [await self._queue.get()]
+                while not self._queue.empty():
+                    batch.append(self._queue.get_nowait())
+                self.batches += 1
+                self.max_batch = max(self.max_batch, len(batch))
+                for priority, _, frame, queued_at, future in batch:
+                    await self._write(websocket, frame, queued_at, future)
+        finally:
+            self._running = False
+            while not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+            for item in batch:  # nobody is going to write these anymore
+                future = item[-1]
+                if not future.done():
+                    future.set_exception(ConnectionError("Writer for " + self.name + " stopped"))
+
+    async def _write(self, websocket, frame: str, queued_at: float, future):
+        try:
+            await websocket.send(frame)
+        except Exception as e:
+            self.failed += 1
+            if not future.done():
+                future.set_exception(e)
+            return
+        latency = time.monotonic() - queued_at
+        self.sent += 1
+        self._latency_total += latency
+        self._latency_last = latency
+        self._latency_max = max(self._latency_max, latency)
+        if not future.done():
+            future.set_result(None)
+
+    def stats(self):
+        return {"depth": self._queue.qsize(),
+                "max_depth": self.max_depth,
+                "sent": self.sent,
+                "failed": self.failed,
+                "batches": self.batches,
+                "max_batch": self.max_batch,
+                "latency_ms": {"last": self._latency_last * 1000,
+                               "avg": self._latency_total / self.sent * 1000 if self.sent else 0,
+                               "max": self._latency_max * 1000}}
@@ -0,0 +1,120 @@
+import asyncio
+import io
+import re
+
+import numpy as np
+import soundfile
+
+from audio_capture import RATE, SAMPLE_WIDTH, to_wav
+
+
+def to_flac(pcm, rate=RATE):
+    """
+    Encode 16 bit mono pcm as FLAC, in memory. Lossless, and a half to two thirds of the size of the WAV for speech.
+    """
+    flac = io.BytesIO()
+    soundfile.write(flac, np.frombuffer(pcm, dtype=np.int16), rate, format="FLAC", subtype="PCM_16")
+    flac.name = "audio.flac"  # the OpenAI client takes the file type from the name
+    flac.seek(0)
+    return flac
+
+
+ENCODERS = {"flac": to_flac,
+            "wav": to_wav}
+
+
+def _normalize(word: str):
+    return "".join(re.findall(r"\w+", word.lower()))
+
+
+def merge_transcripts(texts: list, max_overlap_words=8):
+    """
+    Join the transcripts of overlapping segments, the words at the end of one transcript that are repeated at the
+    start of the next are kept once
+    """
+    merged = []
+    for text in texts:
+        words = text.split()
+        tail = [_normalize(word) for word in merged[-max_overlap_words:]]
+        head = [_normalize(word) for word in words[:max_overlap_words]]
+        repeated = 0
+        for n in range(min(len(tail), len(head)), 0, -1):
+            if tail[-n:] == head[:n]:
+                repeated = n
+                break
+        merged.extend(words[repeated:])
+    return " ".join(merged)
+
+
+class TranscriptionPipeline(object):
+    """
+    Transcribes a recording (an AudioCapture) while it is being made. The audio is encoded before the upload, FLAC by
+    default. With segment_seconds set, recordings that get longer than that are cut into segments that overlap by
+    overlap_seconds, each segment is transcribed as soon as it has been recorded and the transcripts are merged.
+    Recordings shorter than a segment are transcribed in one go, after the recording.
+    """
+
+    def __init__(self, transcribe, audio_format="flac", segment_seconds=None, overlap_seconds=1.0, rate=RATE):
+        self._transcribe = transcribe  # async function(file) returning the text
+        self._encode = ENCODERS[audio_format]
+        self.segment_size = int(segment_seconds * rate) if segment_seconds else None  # samples
+        self.overlap_size = int(overlap_seconds * rate)  # samples
+        self.rate = rate
+
+        self.recordings = 0
+        self.segments = 0
+        self.pcm_bytes = 0
+        self.uploaded_bytes = 0
+
+    async def _transcribe_segment(self, pcm):
+        audio = await asyncio.to_thread(self._encode, pcm, self.rate)
+        self.segments += 1
+        self.pcm_bytes += len(pcm)
+        self.uploaded_bytes += audio.getbuffer().nbytes
+        return await self._transcribe(audio)
+
+    async def run(self, capture):
+        """
+        Transcribe the recording of capture, start this before recording
+        """
+        self.recordings += 1
+        tasks = []
+        try:
+            start = 0  # first sample of the next segment
+            while self.segment_size:
+                end = start + self.segment_size + self.overlap_size
+                await capture.wait_until(end)
+                if capture.done:
+                    break
+                speech = capture.speech_range()
+                if capture.detector is not None and speech is None:
+                    start = end - self.overlap_size  # nothing said yet, do not upload the silence
+                    continue
+                if speech is not None:
+                    start = max(start, speech[0])
+                tasks.append(asyncio.create_task(
+                    self._transcribe_segment(capture.recorded[start * SAMPLE_WIDTH:end * SAMPLE_WIDTH])))
+                start = end - self.overlap_size
+
+            await capture.wait_until()
+            if not tasks:
+                tasks.append(asyncio.create_task(self._transcribe_segment(capture.pcm)))
+            else:
+                speech = capture.speech_range()
+                end = speech[1] if speech is not None else len(capture.recorded) // SAMPLE_WIDTH
+                if end - start > self.overlap_size:  # something was said after the last segment
+                    tasks.append(asyncio.create_task(
+                        self._transcribe_segment(capture.recorded[start * SAMPLE_WIDTH:end * SAMPLE_WIDTH])))
+            texts = await asyncio.gather(*tasks)
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            raise
+        return merge_transcripts(texts)
+
+    def stats(self):
+        return {"recordings": self.recordings,
+                "segments": self.segments,
+                "pcm_bytes": self.pcm_bytes,
+                "uploaded_bytes": self.uploaded_bytes,
+                "compression": round(self.uploaded_bytes / self.pcm_bytes, 3) if self.pcm_bytes else None}
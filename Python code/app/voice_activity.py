@@ -0,0 +1,71 @@
+import numpy as np
+
+FRAME_SECONDS = 0.02
+NOISE_ADAPTATION = 0.05  # how quickly the noise floor follows the frames that are not speech
+
+
+class VoiceActivityDetector(object):
+    """
+    Energy based end of speech detection over 16 bit mono pcm, fed chunk by chunk while recording.
+    A frame counts as speech when its RMS is above threshold and ratio times the noise floor, the noise floor follows
+    the frames that are not speech. Speech starts after start_frames speech frames in a row, and it has ended once
+    trailing_silence seconds went by without speech and at least min_seconds were recorded.
+    """
+
+    def __init__(self, rate=16000, trailing_silence=0.8, min_seconds=1.0, threshold=300, ratio=3.0, start_frames=3,
+                 padding=0.2):
+        self.rate = rate
+        self.frame_size = int(rate * FRAME_SECONDS)  # samples per frame
+        self.threshold = threshold
+        self.ratio = ratio
+        self.start_frames = start_frames
+        self.silence_frames = int(trailing_silence / FRAME_SECONDS)
+        self.min_frames = int(min_seconds / FRAME_SECONDS)
+        self.padding = int(padding * rate)  # samples of silence kept around the speech when trimming
+
+        self._rest = np.zeros(0, dtype=np.int16)  # samples that do not fill a frame yet
+        self._run = 0  # speech frames in a row
+        self.noise_floor = 0.0
+        self.frames = 0
+        self.speech_start = None  # first frame of speech
+        self.speech_end = None  # frame after the last frame of speech
+        self.ended = False
+
+    def feed(self, data):
+        """
+        Analyse the next chunk of pcm, returns whether the speech has ended
+        """
+        samples = np.concatenate((self._rest, np.frombuffer(data, dtype=np.int16)))
+        usable = len(samples) - len(samples) % self.frame_size
+        self._rest = samples[usable:]
+        frames = samples[:usable].reshape(-1, self.frame_size).astype(np.float32)
+        for rms in np.sqrt(np.mean(frames * frames, axis=1)):
+            self._frame(float(rms))
+        return self.ended
+
+    def _frame(self, rms: float):
+        if rms > max(self.threshold, self.noise_floor * self.ratio):
+            self._run += 1
+            if self._run >= self.start_frames:
+                if self.speech_start is None:
+                    self.speech_start = self.frames + 1 - self._run
+                self.speech_end = self.frames + 1
+        else:
+            self._run = 0
+            self.noise_floor += NOISE_ADAPTATION * (rms - self.noise_floor)
+        self.frames += 1
+
+        if (self.speech_end is not None and self.frames - self.speech_end >= self.silence_frames
+                and self.frames >= self.min_frames):
+            self.ended = True
+
+    def speech_range(self, samples: int):
+        """
+        The samples (start, end) of a recording of the given length that hold the speech with some padding,
+        or None when no speech was heard
+        """
+        if self.speech_start is None:
+            return None
+        start = max(0, self.speech_start * self.frame_size - self.padding)
+        end = min(samples, self.speech_end * self.frame_size + self.padding)
+        return start, end
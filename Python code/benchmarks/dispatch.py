@@ -0,0 +1,66 @@
+"""
+Benchmark of the per-frame overhead of ConnectionController.handle_message.
+The handlers are replaced by no-ops, so only the filtering and routing is timed, for dev lists of different sizes.
+
+Run from the 'Python code' directory: python benchmarks/dispatch.py
+"""
+import asyncio
+import os
+import sys
+import time
+
+APP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app")
+os.chdir(APP_DIR)  # the generators load their config relative to the app directory
+sys.path.insert(0, APP_DIR)
+os.environ.setdefault("SERVER_MODE", "DEVELOP")
+
+from connection_controller import ConnectionController, ConnectionStatus, ServerMode  # noqa: E402
+
+FRAMES = 100000
+DEV_LIST_SIZES = [10, 1000, 100000]
+
+
+class _App(object):
+    def add_background_task(self, *args, **kwargs):
+        pass
+
+
+async def _no_op(data: dict):
+    return None
+
+
+def _frames():
+    client = {"id": "tablet-0", "type": "TABLET"}
+    return {"starter": {"type": "non-empathic-starter", "client": client},
+            "conversation": {"type": "message_viewed", "client": client, "data": {"message_id": "conversation"}},
+            "data response": {"type": "tablet_user_data", "client": client, "data": {}},
+            "unknown": {"type": "message_shown", "client": client, "data": {}},
+            "rejected": {"type": "message_shown", "client": {"id": "unknown", "type": "TABLET"}}}
+
+
+async def _time_frames(controller, frame):
+    start = time.perf_counter()
+    for _ in range(FRAMES):
+        await controller.handle_message(frame)
+    return (time.perf_counter() - start) / FRAMES * 1e6
+
+
+async def main():
+    controller = ConnectionController(_App())
+    controller.mode = ServerMode.DEVELOP
+    controller._connected_tablets["tablet-0"] = ConnectionStatus.CONNECTED
+    for handlers in [controller._type_handlers, controller._message_id_handlers]:
+        for key in handlers:
+            handlers[key] = _no_op
+
+    print("dispatch overhead, " + str(FRAMES) + " frames per message")
+    for size in DEV_LIST_SIZES:
+        controller._dev_set = set(["tablet-" + str(i) for i in range(size)])
+        print("  dev list of " + str(size) + " tablets")
+        for name, frame in _frames().items():
+            print("    %-14s %.2f us per frame" % (name + ":", await _time_frames(controller, frame)))
+    controller.dump_history()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
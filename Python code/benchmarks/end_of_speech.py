@@ -0,0 +1,105 @@
+"""
+How long listen_to_audio records for answers of different lengths, with a fixed recording of RECORD_SECONDS and with
+end of speech detection. The answers are synthetic: syllable-like tone bursts over a little background noise, played
+by a SyntheticSource without waiting, so the recorded seconds are what a tablet user would wait for.
+Also reports the time the detector takes per chunk, it runs on the audio thread while recording.
+Fails when a recording does not stop within TOLERANCE of the end of speech plus the trailing silence, or when the upload
+does not hold the speech and its padding.
+
+Run from the 'Python code' directory: python benchmarks/end_of_speech.py
+"""
+import asyncio
+import os
+import random
+import statistics
+import sys
+import time
+from array import array
+
+APP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app")
+os.chdir(APP_DIR)  # the generators load their config relative to the app directory
+sys.path.insert(0, APP_DIR)
+os.environ.setdefault("SERVER_MODE", "DEVELOP")
+
+from audio_capture import AudioCapture, SyntheticSource, CHUNK, RATE, RECORD_SECONDS, SAMPLE_WIDTH, tone  # noqa: E402
+from connection_controller import LISTEN_MIN_SECONDS, LISTEN_TRAILING_SILENCE  # noqa: E402
+from voice_activity import VoiceActivityDetector  # noqa: E402
+
+NOISE = 60  # amplitude of the background noise
+LEAD = 0.5  # seconds before the user speaks
+TOLERANCE = 2 * CHUNK / RATE  # seconds, the detector decides per chunk
+ANSWERS = {"'goed'": [0.4],
+           "'het gaat wel, redelijk'": [0.5, 0.3, 0.6],
+           "a long story": [1.5, 0.4, 2.0, 0.6, 1.8, 0.3, 2.5, 0.5, 3.0],  # speech and pauses, longer than the max
+           "nothing": []}
+
+
+def _noise(seconds: float):
+    return array("h", (random.randint(-NOISE, NOISE) for _ in range(int(seconds * RATE)))).tobytes()
+
+
+def _mix(a: bytes, b: bytes):
+    x, y = array("h", a), array("h", b)
+    return array("h", (max(-32768, min(32767, p + q)) for p, q in zip(x, y))).tobytes()
+
+
+def _answer(parts: list):
+    """
+    Half a second before the user speaks, then the parts alternate between speech and pauses, then silence
+    """
+    pcm = _noise(LEAD)
+    for i, seconds in enumerate(parts):
+        pcm += _mix(tone(seconds, frequency=180 + 40 * i), _noise(seconds)) if i % 2 == 0 else _noise(seconds)
+    return pcm + _noise(RECORD_SECONDS)
+
+
+async def _record(pcm: bytes, detect: bool):
+    detector = VoiceActivityDetector(trailing_silence=LISTEN_TRAILING_SILENCE,
+                                     min_seconds=LISTEN_MIN_SECONDS) if detect else None
+    capture = AudioCapture(SyntheticSource(pcm, realtime=False), detector=detector)
+    await capture.record()
+    return capture.seconds, len(capture.pcm) / SAMPLE_WIDTH / RATE
+
+
+def _check(parts: list, detect: bool, recorded: float, uploaded: float):
+    if not detect:
+        assert abs(recorded - RECORD_SECONDS) <= TOLERANCE and uploaded == recorded, "fixed recording was cut short"
+        return
+    if not parts:  # nothing said, nothing to stop at or trim to
+        assert abs(recorded - RECORD_SECONDS) <= TOLERANCE and uploaded == recorded, "stopped without speech"
+        return
+    speech_end = LEAD + sum(parts if len(parts) % 2 else parts[:-1])  # the parts start and end with speech, or a pause
+    expected = min(RECORD_SECONDS, max(LISTEN_MIN_SECONDS, speech_end + LISTEN_TRAILING_SILENCE))
+    assert abs(recorded - expected) <= TOLERANCE, "recorded %.2f s, expected %.2f s" % (recorded, expected)
+    speech = min(speech_end, recorded) - LEAD
+    padding = 2 * VoiceActivityDetector().padding / RATE
+    assert speech <= uploaded <= speech + padding + TOLERANCE, "uploaded %.2f s for %.2f s of speech" % (uploaded,
+                                                                                                      speech)
+
+
+def _detector_cost():
+    chunk = _answer([1.0])[:CHUNK * SAMPLE_WIDTH]
+    detector = VoiceActivityDetector()
+    timings = []
+    for _ in range(2000):
+        start = time.perf_counter()
+        detector.feed(chunk)
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings) * 1e6
+
+
+async def main():
+    random.seed(1)
+    for name, parts in ANSWERS.items():
+        pcm = _answer(parts)
+        print("answer " + name + ":")
+        for detect in (False, True):
+            recorded, uploaded = await _record(pcm, detect)
+            print("  %-23s recorded %.2f s, uploaded %.2f s of audio"
+                  % ("end of speech detection" if detect else "fixed recording", recorded, uploaded))
+            _check(parts, detect, recorded, uploaded)
+    print("detector: %.1f us per chunk of %d ms" % (_detector_cost(), CHUNK * 1000 / RATE))
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
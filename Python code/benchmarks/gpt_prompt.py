@@ -0,0 +1,87 @@
+"""
+Prompt assembly of the GPT generators, compared with assembling the system prompt (with the time stamp in it) per turn.
+Reports the time to build the messages of a turn, and how much of each request is identical to the start of the
+request of the previous turn, which is the part that OpenAI can serve from its prompt cache.
+The tokens that were actually cached are counted per completion and shown under "gpt" on the /stats page.
+
+Run from the 'Python code' directory: python benchmarks/gpt_prompt.py
+"""
+import datetime
+import json
+import os
+import sys
+import time
+
+APP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app")
+os.chdir(APP_DIR)  # the generators load their config relative to the app directory
+sys.path.insert(0, APP_DIR)
+
+from generators import gpt  # noqa: E402
+
+BUILDS = 20000
+TURNS = 7
+CHARS_PER_TOKEN = 4  # rough estimate, only used to put the byte counts in perspective
+
+
+def _old_build_messages(chat_history: list):
+    ct = datetime.datetime.now()
+    messages = [{"role": "system", "content": gpt.rich_instructions +
+                                              "\n" + gpt.rich_task +
+                                              "\n" + gpt.rich_formats +
+                                              "\n" + f"Time is {ct}"}]
+    return messages + chat_history[-10:]
+
+
+def _new_build_messages(chat_history: list):
+    return gpt.build_messages(gpt.RICH_SYSTEM_MESSAGE, chat_history)
+
+
+def _conversation():
+    history = []
+    for turn in range(TURNS):
+        history.append({"role": "user", "content": "Het gaat wel, ik heb slecht geslapen. (" + str(turn) + ")"})
+        yield list(history)
+        history.append({"role": "assistant", "content": json.dumps({"message": "Wat vervelend om te horen, hoe komt "
+                                                                               "dat denk je?", "end": "no"})})
+
+
+def _time_builds(build):
+    history = list(_conversation())[-1]
+    start = time.perf_counter()
+    for _ in range(BUILDS):
+        build(history)
+    return (time.perf_counter() - start) / BUILDS * 1e6
+
+
+def _shared_prefix(a: str, b: str):
+    n = 0
+    for x, y in zip(a, b):
+        if x != y:
+            break
+        n += 1
+    return n
+
+
+def _reusable(build):
+    previous, shared, total = "", 0, 0
+    for history in _conversation():
+        request = json.dumps(build(history), ensure_ascii=False)
+        time.sleep(0.001)  # a real turn takes seconds, make sure the time stamp moves
+        shared += _shared_prefix(previous, request)
+        total += len(request)
+        previous = request
+    return shared, total
+
+
+def main():
+    print("rich prompt, " + str(TURNS) + " turn conversation")
+    for name, build in [("system prompt per turn", _old_build_messages), ("cached system prompt", _new_build_messages)]:
+        shared, total = _reusable(build)
+        print("  " + name + ":")
+        print("    build:    %.2f us per turn" % _time_builds(build))
+        print("    reusable: %d of %d characters (%.0f%%, ~%d tokens) over the conversation"
+              % (shared, total, shared / total * 100, shared / CHARS_PER_TOKEN))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+"""
+Time to first sentence of a GPT response, streamed and not streamed, against a local fake OpenAI server.
+The fake server sends a canned completion token by token with a fixed delay, the same way the chat completions
+API does with stream=True, so no API key or network is needed.
+Fails when the streamed and the blocking completion differ, or when the first sentence is not delivered whole (past
+the abbreviation in it) before the completion has finished.
+
+Run from the 'Python code' directory: python benchmarks/gpt_streaming.py
+"""
+import asyncio
+import json
+import os
+import sys
+import time
+
+from aiohttp import web
+from openai import AsyncOpenAI
+
+APP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app")
+os.chdir(APP_DIR)  # the generators load their config relative to the app directory
+sys.path.insert(0, APP_DIR)
+os.environ.setdefault("SERVER_MODE", "DEVELOP")
+
+from connection_controller import ConnectionController  # noqa: E402
+
+PORT = 8765
+TOKEN_DELAY = 0.02  # seconds between two streamed tokens
+FIRST_SENTENCE = "Goedemiddag mw. Jansen, wat fijn dat je er bent!"
+COMPLETION = json.dumps({"message": FIRST_SENTENCE + " Hoe voel je je vandaag? "
+                                                      "Heb je lekker geslapen en heb je al iets leuks gedaan vandaag?",
+                         "emotes": {"head": "happy", "lefthand": "wave", "righthand": "default"},
+                         "end": "no"})
+
+
+def _tokens(text: str, size=4):
+    return [text[i:i + size] for i in range(0, len(text), size)]
+
+
+def _chunk(content, finish_reason=None):
+    return {"id": "chatcmpl-fake", "object": "chat.completion.chunk", "created": int(time.time()), "model": "gpt-4o",
+            "choices": [{"index": 0, "delta": {"content": content} if content else {},
+                         "finish_reason": finish_reason}]}
+
+
+async def _completions(request):
+    body = await request.json()
+    tokens = _tokens(COMPLETION)
+    if not body.get("stream"):
+        await asyncio.sleep(TOKEN_DELAY * len(tokens))
+        return web.json_response({"id": "chatcmpl-fake", "object": "chat.completion", "created": int(time.time()),
+                                  "model": "gpt-4o",
+                                  "choices": [{"index": 0, "finish_reason": "stop",
+                                               "message": {"role": "assistant", "content": COMPLETION}}]})
+
+    response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+    await response.prepare(request)
+    for token in tokens:
+        await asyncio.sleep(TOKEN_DELAY)
+        await response.write(("data: " + json.dumps(_chunk(token)) + "\n\n").encode())
+    await response.write(("data: " + json.dumps(_chunk(None, "stop")) + "\n\n").encode())
+    await response.write(b"data: [DONE]\n\n")
+    return response
+
+
+class _App(object):
+    def add_background_task(self, *args, **kwargs):
+        pass
+
+
+async def main():
+    app = web.Application()
+    app.router.add_post("/v1/chat/completions", _completions)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", PORT).start()
+
+    controller = ConnectionController(_App())
+    controller._openai_api = AsyncOpenAI(api_key="fake", base_url="http://127.0.0.1:" + str(PORT) + "/v1")
+    messages = [{"role": "user", "content": "Hallo"}]
+
+    start = time.perf_counter()
+    data = await controller.complete_with_gpt(messages)
+    blocking = time.perf_counter() - start
+
+    first = {}
+
+    async def on_first_sentence(sentence: str):
+        first["sentence"], first["at"] = sentence, time.perf_counter() - start
+
+    start = time.perf_counter()
+    streamed = await controller.complete_with_gpt(messages, on_first_sentence=on_first_sentence)
+    streaming = time.perf_counter() - start
+
+    assert streamed == data == json.loads(COMPLETION)
+    assert first["sentence"] == FIRST_SENTENCE, "delivered " + first["sentence"]
+    assert first["at"] < streaming and first["at"] < blocking, "the first sentence was not delivered early"
+    print("first sentence: " + first["sentence"])
+    print("  not streamed: %.0f ms until the first sentence" % (blocking * 1000))
+    print("  streamed:     %.0f ms until the first sentence (%.0f ms until complete)" % (first["at"] * 1000,
+                                                                                      streaming * 1000))
+    controller.dump_history()
+    await runner.cleanup()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
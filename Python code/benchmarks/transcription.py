@@ -0,0 +1,128 @@
+"""
+Bytes uploaded and the time from the end of speech to the transcript, for a short answer and a long story, uploaded as
+WAV, as FLAC, and as FLAC in segments that are transcribed while recording.
+The recordings come from a SyntheticSource in real time and go through ConnectionController.listen_to_audio to a
+local fake transcription endpoint. The fake decodes the upload and takes UPLINK to receive it plus a fixed latency and
+a time per second of audio to transcribe it, so no API key or network is needed. It finds the upload in the recording
+that is playing (the encodings are lossless) and transcribes it as one word per second of the recording, "w3" for the
+fourth second, for every second whose middle it holds.
+The synthetic speech is shaped noise, real speech compresses a little better.
+Fails when a transcript differs from that of the WAV upload in one go, when FLAC is not smaller than WAV, or when a
+long story is not uploaded in segments that make the transcript arrive sooner.
+
+Run from the 'Python code' directory: python benchmarks/transcription.py
+"""
+import asyncio
+import io
+import os
+import sys
+import time
+
+import numpy as np
+import soundfile
+from aiohttp import web
+from openai import AsyncOpenAI
+
+APP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app")
+os.chdir(APP_DIR)  # the generators load their config relative to the app directory
+sys.path.insert(0, APP_DIR)
+os.environ.setdefault("SERVER_MODE", "DEVELOP")
+
+from audio_capture import RATE, SyntheticSource  # noqa: E402
+from connection_controller import ConnectionController  # noqa: E402
+from transcription import TranscriptionPipeline  # noqa: E402
+
+PORT = 8766
+UPLINK = 1e6 / 8  # bytes per second, 1 Mbit/s
+LATENCY = 0.3  # seconds per request
+SECONDS_PER_SECOND = 0.05  # seconds to transcribe a second of audio
+ANSWERS = {"short answer (2 s)": 2.0, "long story (8 s)": 8.0}
+MATCH_SAMPLES = 64  # samples at the start of an upload that are looked up in the recording
+
+_playing = np.zeros(0, dtype=np.int16)  # the recording the source is playing
+
+PIPELINES = {"wav": dict(audio_format="wav"),
+             "flac": dict(audio_format="flac"),
+             "flac, 5 s segments": dict(audio_format="flac", segment_seconds=5, overlap_seconds=1)}
+
+
+def _speech(seconds: float):
+    """
+    Half a second of quiet, then low-passed noise with a syllable rhythm, then quiet
+    """
+    rng = np.random.default_rng(1)
+    n = int(seconds * RATE)
+    voiced = np.convolve(rng.normal(0, 1, n), np.ones(8) / 8, mode="same")
+    rhythm = 0.6 + 0.4 * np.sin(2 * np.pi * 4 * np.arange(n) / RATE)
+    speech = (voiced * rhythm * 6000).astype(np.int16)
+    quiet = lambda s: rng.normal(0, 20, int(s * RATE)).astype(np.int16)  # noqa: E731
+    return np.concatenate((quiet(0.5), speech, quiet(10))).tobytes()
+
+
+def _words(samples):
+    """
+    One word for every second of the playing recording whose middle is in samples
+    """
+    windows = np.lib.stride_tricks.sliding_window_view(_playing, MATCH_SAMPLES)
+    start = int(np.flatnonzero((windows == samples[:MATCH_SAMPLES]).all(axis=1))[0]) / RATE
+    end = start + len(samples) / RATE
+    return " ".join("w%d" % second for second in range(int(end) + 1) if start <= second + 0.5 < end)
+
+
+async def _transcriptions(request):
+    form = await request.post()
+    upload = form["file"].file.read()
+    samples, rate = soundfile.read(io.BytesIO(upload), dtype="int16")
+    await asyncio.sleep(len(upload) / UPLINK + LATENCY + len(samples) / rate * SECONDS_PER_SECOND)
+    return web.json_response({"text": _words(samples)})
+
+
+class _App(object):
+    def add_background_task(self, *args, **kwargs):
+        pass
+
+
+async def main():
+    global _playing
+    app = web.Application(client_max_size=16 * 1024 * 1024)
+    app.router.add_post("/v1/audio/transcriptions", _transcriptions)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", PORT).start()
+
+    controller = ConnectionController(_App())
+    controller._openai_api = AsyncOpenAI(api_key="fake", base_url="http://127.0.0.1:" + str(PORT) + "/v1")
+
+    for answer, seconds in ANSWERS.items():
+        print(answer + ":")
+        _playing = np.frombuffer(_speech(seconds), dtype=np.int16)
+        results = {}
+        for name, options in PIPELINES.items():
+            controller._transcription = TranscriptionPipeline(controller.transcribe_with_whisper, **options)
+            controller.audio_source = SyntheticSource(_playing.tobytes())
+            transcription = await controller.listen_to_audio()
+            end_of_recording = time.perf_counter()
+            text = await transcription
+            waited = time.perf_counter() - end_of_recording
+            stats = controller.transcription_stats()
+            results[name] = (text, stats, waited)
+            print("  %-19s %7d bytes in %d upload(s), transcript %4.0f ms after the recording (%s)"
+                  % (name, stats["uploaded_bytes"], stats["segments"], waited * 1000, text))
+
+        reference = results["wav"][0]
+        assert reference, "nothing was transcribed"
+        for name, (text, stats, waited) in results.items():
+            assert text == reference, name + " transcript differs: " + text
+        assert results["flac"][1]["uploaded_bytes"] < results["wav"][1]["uploaded_bytes"], "FLAC is not smaller"
+        segmented, whole = results["flac, 5 s segments"], results["flac"]
+        if seconds > PIPELINES["flac, 5 s segments"]["segment_seconds"]:
+            assert segmented[1]["segments"] > 1, "a long story was uploaded in one go"
+            assert segmented[2] < whole[2], "the segments did not make the transcript arrive sooner"
+        else:
+            assert segmented[1]["segments"] == 1, "a short answer was cut into segments"
+    controller.dump_history()
+    await runner.cleanup()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,78 @@
+"""
+Benchmark of variable.fill on a template that uses every weather forecast variable.
+Compares the current get_translation with the pandas filter + sample lookup it replaced.
+
+Run from the 'Python code' directory: python benchmarks/variable_fill.py
+"""
+import asyncio
+import os
+import sys
+import time
+from datetime import datetime, timedelta
+
+APP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app")
+os.chdir(APP_DIR)  # the generators load their config relative to the app directory
+sys.path.insert(0, APP_DIR)
+
+from generators import variable  # noqa: E402
+
+FILLS = 200
+
+
+def _pandas_get_translation(key: str, lang: str):
+    variables_df = variable.variables_df
+    available_variables = variables_df[variables_df['varname'] == key]
+    variables_lang = available_variables[available_variables['lang'] == lang]
+    if len(variables_lang) == 0:
+        return key
+    return variables_lang.sample(1)['value'].to_numpy()[0]
+
+
+def _forecast(items=20):
+    start = datetime.utcnow().replace(minute=0, second=0, microsecond=0)
+    forecast = []
+    for i in range(items):
+        forecast.append({"dt_txt": (start + timedelta(hours=3 * i)).strftime('%Y-%m-%d %H:%M:%S'),
+                         "weather": [{"description": "lichte regen"}],
+                         "main": {"temp": 11.3, "feels_like": 9.8, "temp_min": 10.1, "temp_max": 12.4,
+                                  "humidity": 81, "pressure": 1012},
+                         "visibility": 10000,
+                         "wind": {"speed": 5.2, "deg": 230},
+                         "clouds": {"all": 90},
+                         "rain": {"1h": 0.4},
+                         "snow": {"1h": 0.0}})
+    return {"list": forecast}
+
+
+class _Controller(object):
+    async def get_weather_forecast_data(self, tablet_id: str, lang="en"):
+        return _forecast()
+
+
+async def _time_fills(template: str, controller):
+    start = time.perf_counter()
+    for _ in range(FILLS):
+        await variable.fill(template, "benchmark", controller, lang="nl")
+    return (time.perf_counter() - start) / FILLS * 1000
+
+
+async def main():
+    template = " ".join('["' + key + '"]' for key in variable.defaults if key.startswith("WEATHER-FORECAST"))
+    controller = _Controller()
+
+    indexed = await _time_fills(template, controller)
+    get_translation = variable.get_translation
+    variable.get_translation = _pandas_get_translation
+    try:
+        pandas = await _time_fills(template, controller)
+    finally:
+        variable.get_translation = get_translation
+
+    print("weather forecast fill, " + str(FILLS) + " fills")
+    print("  pandas lookup:  %.2f ms per fill" % pandas)
+    print("  indexed lookup: %.2f ms per fill" % indexed)
+    print("  speed-up:       %.1fx" % (pandas / indexed))
+
+
+if __name__ == "__main__":
+    asyncio.run(main())